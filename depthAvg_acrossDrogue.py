@@ -1,5 +1,6 @@
 #Code for averaging u and v mercator velocities across 6m drogue length, centered at 15m
 #generates daily depth averaged netcdf files, then combines into a single file for each year.
+#daily Mercator files are read ahead on a thread pool (prefetchDepth days) while the current day is averaged and written
 import numpy as np
 import pylab as p
 import xarray as xr
@@ -11,9 +12,140 @@ import pandas as pd
 import time
 import sys
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy import interpolate
 
+#linear interpolation in depth is a fixed weighted sum of the levels, so averaging across the drogue reduces to one weight
+#per level - returns the weights on levels iDep for the mean of the values interpolated at depths dList (as interp1d does)
+def drogueWeights(iDep, dList=[12.,15.,18.]):
+    iDep = np.asarray(iDep,dtype=np.float64)
+    weights = np.zeros(len(iDep))
+    for d in dList:
+        assert (d>=iDep[0]) and (d<=iDep[-1]), 'depth %s outside of interpolation levels'%(d)
+        k = min(np.searchsorted(iDep,d,side='right')-1,len(iDep)-2) #level above d
+        frac = (d-iDep[k])/(iDep[k+1]-iDep[k])
+        weights[k] += (1.-frac)/len(dList)
+        weights[k+1] += frac/len(dList)
+    return(weights)
+
+#average a block of days (N days x levels x y x x) across the drogue using weights from drogueWeights -> (N x y x x)
+#accumulates in float32; levels with zero weight are skipped so that nans there don't spread (as with interp1d)
+def drogueAverage(block, weights):
+    use = np.flatnonzero(weights)
+    block = np.asarray(block)[:,use].astype(np.float32,copy=False)
+    return(np.einsum('nkyx,k->nyx',block,weights[use].astype(np.float32)))
+
+#time units for the yearly files written in direct mode
+timeUnits = 'seconds since 1950-01-01 00:00:00'
+
+#index of the first day not yet written to a partial yearly file (0 if there is none)
+def firstMissingDay(fname):
+    partName = fname+'.part'
+    if not os.path.exists(partName):
+        return(0)
+    with nc.Dataset(partName,'r') as ds:
+        done = ~np.ma.getmaskarray(ds['time'][:]) #time is written after the velocities, so it marks finished days
+    return(len(done) if np.all(done) else np.argmin(done))
+
+#create (or reopen, to resume) a yearly file with one time slot per day in dates, for writing days into directly
+#the file is written as fname.part and only renamed to fname once every day is done (see closeYearFile)
+#returns the open netCDF4 dataset and the index of the first day that still has to be written
+def openYearFile(fname, varName, lonName, latName, navLon, navLat, dates, attrs):
+    partName = fname+'.part'
+    if os.path.exists(partName):
+        firstMissing = firstMissingDay(fname)
+        ds = nc.Dataset(partName,'a')
+        print('resuming %s from %s'%(fname,dates[firstMissing] if firstMissing<len(dates) else 'end'))
+        return(ds,firstMissing)
+
+    ny, nx = navLon.shape
+    ds = nc.Dataset(partName,'w',format='NETCDF4')
+    ds.createDimension('time',len(dates))
+    ds.createDimension('depth',1)
+    ds.createDimension('y',ny)
+    ds.createDimension('x',nx)
+    tVar = ds.createVariable('time','f8',('time',)) #unwritten days read as masked
+    tVar.units = timeUnits
+    tVar.calendar = 'standard'
+    ds.createVariable('depth','f8',('depth',))[:] = [15.]
+    ds.createVariable(lonName,'f4',('y','x'))[:] = navLon
+    ds.createVariable(latName,'f4',('y','x'))[:] = navLat
+    #one day per chunk, tiled in space, so that Parcels reads only the days (and tiles with indices) it needs
+    vel = ds.createVariable(varName,'f4',('time','depth','y','x'),fill_value=np.float32(np.nan),
+                            chunksizes=(1,1,min(ny,chunkYX),min(nx,chunkYX)))
+    vel.coordinates = '%s %s'%(lonName,latName)
+    ds.setncatts(attrs)
+    return(ds,0)
+
+#write a day (or block of days) into the yearly file at time index ti
+def writeDays(ds, varName, ti, avg, times):
+    ds[varName][ti:ti+len(avg),0] = avg
+    ds['time'][ti:ti+len(avg)] = nc.date2num(pd.to_datetime(times).to_pydatetime(),timeUnits,'standard')
+    ds.sync()
+
+#close a yearly file and move it into place once all days are written
+def closeYearFile(ds, fname):
+    complete = not np.any(np.ma.getmaskarray(ds['time'][:]))
+    ds.close()
+    assert complete, '%s is missing days, rerun to resume'%(fname)
+    os.rename(fname+'.part',fname)
+
+#netCDF/HDF5 isn't thread safe, so reads on the prefetch threads and writes on the main thread take turns
+ncLock = threading.Lock()
+
+#read the Mercator u and v files for a single day - only levels 8:12 (around the drogue) of the velocities are read
+def readDay(date):
+    #get name for daily u and v files from Mercator data (thisDay is an older naming convention)
+    thisDay=mdates.date2num(date)- mdates.date2num(np.datetime64('0000-12-31')) 
+    uDataName = dataDir+'umerc_phy_%0.0d.nc'%(thisDay,)
+    vDataName = dataDir+'vmerc_phy_%0.0d.nc'%(thisDay,)
+
+    with ncLock:
+        #open u and v files; get velocities
+        uField = xr.open_dataset(uDataName)
+        vField = xr.open_dataset(vDataName)
+        uF = uField['vozocrtx'] #u velocity (zo is for zonal)
+        vF = vField['vomecrty'] #v velocity (me is for meridional)
+        day = dict(u=uF[:,8:12,:,:].values,
+                   v=vF[:,8:12,:,:].values,
+                   iDep=uField['deptht'][8:12].values,
+                   time_ct=uF['time_counter'].values,
+                   #latitude and longitude of u and v points
+                   unLon=uF['nav_lon'].values,
+                   unLat=uF['nav_lat'].values,
+                   vnLon=vF['nav_lon'].values,
+                   vnLat=vF['nav_lat'].values)
+        uField.close()
+        vField.close()
+    return(day)
+
+#regression test against the interp1d average and per-day timing, on synthetic data with the Mercator levels used (8:12)
+if False:
+    iDep = np.array([11.405,13.467,15.810,18.496])
+    nDays, ny, nx = 4, 1000, 1500
+    testU = np.random.normal(0.,0.5,(nDays,4,ny,nx)).astype(np.float32)
+    testU[:,3,:10,:10] = np.nan #land below the bottom of the drogue
+
+    t1 = time.time()
+    refAvg = []
+    for day in range(nDays):
+        int_fun = interpolate.interp1d(iDep,testU[day],axis=0)
+        refAvg.append((int_fun(12)+int_fun(15)+int_fun(18))/3.0)
+    refAvg = np.array(refAvg)
+    tInterp = (time.time()-t1)/nDays
+
+    weights = drogueWeights(iDep)
+    t1 = time.time()
+    wAvg = drogueAverage(testU,weights)
+    tWeights = (time.time()-t1)/nDays
+
+    assert np.array_equal(np.isnan(refAvg),np.isnan(wAvg)), 'nans do not match interp1d'
+    assert np.nanmax(np.abs(refAvg-wAvg))<1e-5, 'weighted average does not match interp1d'
+    print('max difference from interp1d: %0.2g m/s'%(np.nanmax(np.abs(refAvg-wAvg))))
+    print('per day: interp1d %0.3fs, weights %0.3fs (%0.1fx)'%(tInterp,tWeights,tInterp/tWeights))
+
 if True:
     print('code will not run without a path to Mercator velocity files')
 
@@ -25,6 +157,11 @@ dataDir=None #path to velocity data from Mercator physical model
 saveDir = None #where to save data
 whatYear = 2010 #year over which to iterate depth-averaging code
 sName = 'depthAvg_6mDrogue_15mCenter_%s_'%(whatYear) #name to save files
+#'direct' writes each day straight into its time slot of a preallocated yearly file (resumes from the last completed day),
+#'tempfiles' writes daily files to temp_data/ and combines them with open_mfdataset at the end
+writeMode = 'direct'
+chunkYX = 512 #spatial chunk size of the yearly files in direct mode (each chunk holds a single day)
+prefetchDepth = 2 #number of days read ahead while the current day is averaged and written
 
 #test to see if file exists (to avoid overwriting completed files)
 sName_full_u = saveDir+sName+'u.nc'
@@ -40,80 +177,6 @@ end = dt.datetime(whatYear,12,31,0,0)
 uFileNameList = []
 vFileNameList = []
 
-#depth average across drogue length for each day in whatYear:
-for date in pd.date_range(start,end):
-    #names for averaged u and v files
-    uFname = 'temp_data/uAvg_15mCent_6mLen_%s_%s_%s.nc'%(date.year,date.month,date.day)
-    vFname = 'temp_data/vAvg_15mCent_6mLen_%s_%s_%s.nc'%(date.year,date.month,date.day)
-
-    #get name for daily u and v files from Mercator data (thisDay is an older naming convention)
-    thisDay=mdates.date2num(date)- mdates.date2num(np.datetime64('0000-12-31')) 
-    uDataName = dataDir+'umerc_phy_%0.0d.nc'%(thisDay,)
-    vDataName = dataDir+'vmerc_phy_%0.0d.nc'%(thisDay,)
-
-    #open u and v files; get velocities
-    uField = xr.open_dataset(uDataName)
-    vField = xr.open_dataset(vDataName)
-    uF = uField['vozocrtx'] #u velocity (zo is for zonal)
-    vF = vField['vomecrty'] #v velocity (me is for meridional)
-    
-    #get coords for dataArray
-    xArr = uF['x'].values
-    yArr = uF['y'].values
-    time_ct = uF['time_counter'].values
-    dpth = [15.]
-
-    #latitude and longitude of u and v points
-    vnLon = vF['nav_lon'].values
-    vnLat = vF['nav_lat'].values
-    unLon = uF['nav_lon'].values
-    unLat = uF['nav_lat'].values
-    
-    #interpolate velocities across drogue length
-    interp_dep = uField['deptht'][:].values
-    iDep = interp_dep[8:12]
-    u_used = uField['vozocrtx'][0,8:12,:,:].values
-    v_used = vField['vomecrty'][0,8:12,:,:].values
-    int_fun_u = interpolate.interp1d(iDep,u_used,axis=0)
-    int_fun_v = interpolate.interp1d(iDep,v_used,axis=0)#faster than xarray's inbuilt interpolation
-    
-    #6m drogue length - based on Pacific Gyre manufactured drogues
-    #interpolate at top, bottom, and middle of drogue
-    uTop = int_fun_u(12)
-    uMid = int_fun_u(15)
-    uBot = int_fun_u(18)
-    
-    vTop = int_fun_v(12)
-    vMid = int_fun_v(15)
-    vBot = int_fun_v(18)
-    
-    #compute average velocities across drogue depth and add dims for DataArray
-    uAvg = np.expand_dims((uTop+uMid+uBot)/3.0,axis=(0,1))
-    vAvg = np.expand_dims((vTop+vMid+vBot)/3.0,axis=(0,1))
-
-    #create DataArrays and append
-    uDs = xr.DataArray(data=uAvg,name = 'uAvg',dims=['time','depth','y','x'],
-                       coords=dict(u_lon=(['y','x'],unLon),
-                                   u_lat=(['y','x'],unLat),
-                                   time=time_ct,
-                                   depth=dpth))
-    vDs = xr.DataArray(data=vAvg,name = 'vAvg',dims=['time','depth','y','x'],
-                       coords=dict(v_lon=(['y','x'],vnLon),
-                                   v_lat=(['y','x'],vnLat),
-                                   time=time_ct,
-                                   depth=dpth))
-    
-    uFileNameList.append(saveDir+uFname)
-    vFileNameList.append(saveDir+vFname)
-
-    #save individual u and v files as netcdf
-    uDs.to_netcdf(saveDir+uFname)
-    vDs.to_netcdf(saveDir+vFname)
-    print('%s done in %s'%(date, time.time()-t1))
-
-
-#now combine netcdf files for each year and add attributes
-
 #create attribute dicts:
 at_institution = 'University of New Hampshire'
 at_source = 'Original model data from the Mercator Ocean 1/12 degree phsyical model PSY4V3R1 on the native model grid'
@@ -147,32 +210,118 @@ v_attrs = dict(title = v_at_title,
                long_name = v_at_long_name,
                standard_name = v_at_standard_name)
 
-#open all daily .nc files as single xarray dataset and save as .nc file
-print('making combined files...')
-print('opening u files as single dataset for %s'%(whatYear))
-u_bigFile = xr.open_mfdataset(uFileNameList,parallel=True)
-print('done opening u dataset')
-u_bigFile.attrs = u_attrs
-print('saving u values to netcdf for %s'%(whatYear))
-write_job = u_bigFile.to_netcdf(sName_full_u,compute=False) #save
+dateList = pd.date_range(start,end)
+uOut = None #yearly files, opened on the first day (direct mode)
+firstDay = 0
+if writeMode=='direct': #skip days already written by an interrupted run
+    firstDay = min(firstMissingDay(sName_full_u),firstMissingDay(sName_full_v))
+
+#start reading the first days
+ioPool = ThreadPoolExecutor(max_workers=prefetchDepth)
+reads = {ti:ioPool.submit(readDay,dateList[ti]) for ti in range(firstDay,min(firstDay+prefetchDepth+1,len(dateList)))}
+ioWait = 0. #time spent waiting on reads
+tYear = time.time()
+
+#depth average across drogue length for each day in whatYear:
+weights = None #interpolation weights (depth levels are the same every day)
+dpth = [15.]
+for ti in range(firstDay,len(dateList)):
+    date = dateList[ti]
+    t1 = time.time()
+    #names for averaged u and v files
+    uFname = 'temp_data/uAvg_15mCent_6mLen_%s_%s_%s.nc'%(date.year,date.month,date.day)
+    vFname = 'temp_data/vAvg_15mCent_6mLen_%s_%s_%s.nc'%(date.year,date.month,date.day)
+
+    #wait for this day's read and queue the next one
+    day = reads.pop(ti).result()
+    ioWait += time.time()-t1
+    if ti+prefetchDepth+1<len(dateList):
+        reads[ti+prefetchDepth+1] = ioPool.submit(readDay,dateList[ti+prefetchDepth+1])
+    time_ct = day['time_ct']
+    unLon, unLat, vnLon, vnLat = day['unLon'], day['unLat'], day['vnLon'], day['vnLat']
+
+    #open (or resume) yearly files on the first day
+    if (writeMode=='direct') and (uOut is None):
+        with ncLock:
+            uOut, _ = openYearFile(sName_full_u,'uAvg','u_lon','u_lat',unLon,unLat,dateList,u_attrs)
+            vOut, _ = openYearFile(sName_full_v,'vAvg','v_lon','v_lat',vnLon,vnLat,dateList,v_attrs)
+    
+    #interpolate velocities across drogue length
+    #6m drogue length - based on Pacific Gyre manufactured drogues
+    #average of velocities interpolated at top, bottom, and middle of drogue, as fixed weights on levels 8:12
+    if weights is None:
+        weights = drogueWeights(day['iDep'],[12.,15.,18.])
+    
+    #compute average velocities across drogue depth and add depth dim for DataArray
+    uAvg = np.expand_dims(drogueAverage(day['u'],weights),axis=1)
+    vAvg = np.expand_dims(drogueAverage(day['v'],weights),axis=1)
+
+    if writeMode=='direct':
+        with ncLock:
+            writeDays(uOut,'uAvg',ti,uAvg,time_ct)
+            writeDays(vOut,'vAvg',ti,vAvg,time_ct)
+        print('%s done in %s'%(date, time.time()-t1))
+        continue
+
+    #create DataArrays and append
+    uDs = xr.DataArray(data=uAvg,name = 'uAvg',dims=['time','depth','y','x'],
+                       coords=dict(u_lon=(['y','x'],unLon),
+                                   u_lat=(['y','x'],unLat),
+                                   time=time_ct,
+                                   depth=dpth))
+    vDs = xr.DataArray(data=vAvg,name = 'vAvg',dims=['time','depth','y','x'],
+                       coords=dict(v_lon=(['y','x'],vnLon),
+                                   v_lat=(['y','x'],vnLat),
+                                   time=time_ct,
+                                   depth=dpth))
+    
+    uFileNameList.append(saveDir+uFname)
+    vFileNameList.append(saveDir+vFname)
+
+    #save individual u and v files as netcdf
+    with ncLock:
+        uDs.to_netcdf(saveDir+uFname)
+        vDs.to_netcdf(saveDir+vFname)
+    print('%s done in %s'%(date, time.time()-t1))
+
+ioPool.shutdown()
+tYear = time.time()-tYear
+print('%s: waited %0.1fs on reads out of %0.1fs (I/O wait fraction %0.2f, prefetch depth %s)'%(whatYear,ioWait,tYear,ioWait/max(tYear,1e-9),prefetchDepth))
+
+if writeMode=='direct':
+    if uOut is None: #every day was already written by an earlier run
+        uOut, _ = openYearFile(sName_full_u,'uAvg','u_lon','u_lat',None,None,dateList,u_attrs)
+        vOut, _ = openYearFile(sName_full_v,'vAvg','v_lon','v_lat',None,None,dateList,v_attrs)
+    closeYearFile(uOut,sName_full_u)
+    closeYearFile(vOut,sName_full_v)
+    print('Done with year %s'%(whatYear))
+
+elif writeMode=='tempfiles': #open all daily .nc files as single xarray dataset and save as .nc file
+    print('making combined files...')
+    print('opening u files as single dataset for %s'%(whatYear))
+    u_bigFile = xr.open_mfdataset(uFileNameList,parallel=True)
+    print('done opening u dataset')
+    u_bigFile.attrs = u_attrs
+    print('saving u values to netcdf for %s'%(whatYear))
+    write_job = u_bigFile.to_netcdf(sName_full_u,compute=False) #save
 
-with ProgressBar():
-    print(f"Writing to %s"%(sName_full_u))
-    write_job.compute()
+    with ProgressBar():
+        print(f"Writing to %s"%(sName_full_u))
+        write_job.compute()
 
-u_bigFile.close()
+    u_bigFile.close()
 
-print('opening v files as single dataset for %s'%(whatYear))
-v_bigFile = xr.open_mfdataset(vFileNameList,parallel=True)
-print('done opening v dataset')
-v_bigFile.attrs = v_attrs
-print('saving v values to netcdf for %s'%(whatYear))
-write_job = v_bigFile.to_netcdf(sName_full_v) #save
+    print('opening v files as single dataset for %s'%(whatYear))
+    v_bigFile = xr.open_mfdataset(vFileNameList,parallel=True)
+    print('done opening v dataset')
+    v_bigFile.attrs = v_attrs
+    print('saving v values to netcdf for %s'%(whatYear))
+    write_job = v_bigFile.to_netcdf(sName_full_v,compute=False) #save
 
-with ProgressBar():
-    print(f"Writing to %s"%(sName_full_v))
-    write_job.compute()
+    with ProgressBar():
+        print(f"Writing to %s"%(sName_full_v))
+        write_job.compute()
 
-v_bigFile.close()
+    v_bigFile.close()
 
-print('Done with year %s'%(whatYear))
+    print('Done with year %s'%(whatYear))
@@ -0,0 +1,305 @@
+#Module for median and IQR statistics of normalized dispersal vectors for every drifter duration (figures 5 and 6)
+#GDP drifter dispersal vectors are normalized by the numerical centroid for their ID (R_d^obs), as are the numerical drifters
+#(R_d^m); stats are computed from the dispersal vector store (loadDistances) with partition-based quantiles, or for the
+#numerical ensembles optionally with bounded-memory quantile sketches (see newSketch), and bootstrap confidence intervals
+#from resampling start IDs (see bootstrapPld)
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from loadData import loadDistances
+from groupByID import segmentRepeat
+
+#quantiles of a float array with linear interpolation (same as np.percentile/np.median/sps.iqr defaults)
+#uses a single np.partition for all quantiles; with overwrite=True x is partitioned in place instead of copied
+def quantiles(x, qs, overwrite=False):
+    n = len(x)
+    if n==0:
+        return(np.full(len(qs),np.nan))
+    h = (n-1)*np.asarray(qs,dtype=np.float64)
+    lo = np.floor(h).astype(np.int64)
+    hi = np.minimum(lo+1,n-1)
+    kth = np.unique(np.r_[lo,hi])
+    if overwrite:
+        x.partition(kth)
+        part = x
+    else:
+        part = np.partition(x,kth)
+    return(part[lo]+(h-lo)*(part[hi]-part[lo]))
+
+#median and iqr of a float array
+def medianIqr(x, overwrite=False):
+    q25, q50, q75 = quantiles(x,[0.25,0.5,0.75],overwrite)
+    return(q50,q75-q25)
+
+#normalized GDP (pArr) and numerical (mArr) dispersal vectors for a single pld, from the dispersal vector store
+#IDs where the centroid doesn't move are ignored, as are nans and infinite values of pArr and nans in the numerical vectors
+#with numerical=False only pArr is returned (the numerical ensemble is not read)
+def normalizedVectors(pld, numerical=True):
+    dist = loadDistances(pld) #precomputed dispersal vectors for this drifter duration only (memory mapped)
+    cen = dist['centroids'].astype(complex)
+    moving = cen!=0 #ignore non-moving numerical drifters
+    pArr = dist['drifters'][moving]/cen[moving] #normalize GDP drifter disp. vectors by centroid vector
+    pArr = pArr[np.isfinite(pArr)] #remove nans and infinite values
+    if not numerical:
+        return(pArr)
+
+    num = dist['numerical']
+    keep = segmentRepeat(moving,dist['numOffsets'])&~np.isnan(num) #ignore nans in numerical disp vectors
+    mArr = num[keep]/segmentRepeat(cen,dist['numOffsets'])[keep] #normalize numerical drifter dispersal vectors by the centroid for their ID
+    assert not np.any(np.isnan(mArr)), 'nans in normalized numerical dispersal vectors' #catch any nans in normalization
+    return(pArr,mArr)
+
+#normalized GDP dispersal (pId, nan where not finite) for each ID with a moving centroid, and the normalized numerical
+#dispersal vectors (mArr) with the index of their ID in pId (mRec) - the per-ID layout needed for resampling IDs
+def idVectors(pld):
+    dist = loadDistances(pld) #(memory mapped)
+    cen = dist['centroids'].astype(complex)
+    moving = cen!=0 #ignore non-moving numerical drifters
+    pId = dist['drifters'][moving]/cen[moving]
+    pId[~np.isfinite(pId)] = np.nan
+
+    num = dist['numerical']
+    rec = segmentRepeat(np.cumsum(moving)-1,dist['numOffsets']) #index among moving IDs
+    keep = segmentRepeat(moving,dist['numOffsets'])&~np.isnan(num) #ignore nans in numerical disp vectors
+    mArr = num[keep]/segmentRepeat(cen,dist['numOffsets'])[keep]
+    return(pId,mArr,rec[keep])
+
+#---quantile sketches---
+#mergeable sketch of a stream of values with log-spaced bins: the values either side of any quantile are returned with a
+#relative error of at most alpha (for |values| between minValue and maxValue; smaller values count as 0 and larger ones go in
+#the outermost bin) - on small ensembles the quartiles can be close together compared with that error, so the values
+#themselves are also kept until there are more than exactMax of them, and quantiles are exact up to then
+#a sketch is a dict of bin counts for positive and negative values, so sketches from chunks, plds or workers add together
+def newSketch(alpha=0.005, minValue=1e-9, maxValue=1e9, exactMax=2**16):
+    gamma = (1.+alpha)/(1.-alpha)
+    nBins = int(np.ceil(np.log(maxValue/minValue)/np.log(gamma)))+1
+    return(dict(alpha=alpha,gamma=gamma,minValue=minValue,nBins=nBins,
+                pos=np.zeros(nBins,dtype=np.int64),neg=np.zeros(nBins,dtype=np.int64),zero=0,
+                exactMax=exactMax,exact=np.zeros(0)))
+
+#keep values in a sketch's exact values while there are no more than exactMax (None once there are more)
+def keepExact(sketch, values):
+    if sketch['exact'] is not None:
+        sketch['exact'] = np.r_[sketch['exact'],values] if len(sketch['exact'])+len(values)<=sketch['exactMax'] else None
+    return(sketch)
+
+#add an array of values to a sketch (in place)
+def addToSketch(sketch, values):
+    values = np.asarray(values,dtype=np.float64)
+    mag = np.abs(values)
+    big = mag>=sketch['minValue']
+    key = np.ceil(np.log(mag[big]/sketch['minValue'])/np.log(sketch['gamma'])).astype(np.int64)
+    key = np.clip(key,0,sketch['nBins']-1)
+    neg = values[big]<0
+    sketch['pos'] += np.bincount(key[~neg],minlength=sketch['nBins'])
+    sketch['neg'] += np.bincount(key[neg],minlength=sketch['nBins'])
+    sketch['zero'] += int(np.sum(~big))
+    return(keepExact(sketch,values))
+
+#combine sketches built with the same parameters
+def mergeSketches(sketches):
+    merged = dict(sketches[0])
+    merged['pos'] = np.sum([x['pos'] for x in sketches],axis=0)
+    merged['neg'] = np.sum([x['neg'] for x in sketches],axis=0)
+    merged['zero'] = int(np.sum([x['zero'] for x in sketches]))
+    merged['exact'] = np.zeros(0)
+    for x in sketches:
+        keepExact(merged,x['exact'] if x['exact'] is not None else np.zeros(merged['exactMax']+1))
+    return(merged)
+
+#linearly interpolated quantiles from a sketch (as np.percentile) - exact while the sketch still has its values, otherwise
+#the values at the two ranks either side of each quantile are taken from their bins (each within a relative error alpha of
+#the value at that rank), so each quantile is within alpha*max(|lower value|,|upper value|) of the exact quantile, and an iqr
+#is within about alpha*(|q25|+|q75|) of the exact iqr
+def sketchQuantiles(sketch, qs):
+    if sketch['exact'] is not None:
+        return(quantiles(sketch['exact'],qs))
+    #bins in increasing order of value: negative bins from largest magnitude down, zero, then positive bins
+    keys = np.arange(sketch['nBins'])
+    binValue = sketch['minValue']*2.*sketch['gamma']**keys/(sketch['gamma']+1.) #value with the smallest relative error in each bin
+    values = np.r_[-binValue[::-1],0.,binValue]
+    counts = np.r_[sketch['neg'][::-1],sketch['zero'],sketch['pos']]
+    n = np.sum(counts)
+    if n==0:
+        return(np.full(len(qs),np.nan))
+    h = np.asarray(qs,dtype=np.float64)*(n-1) #(0-based rank)
+    lo = np.floor(h)
+    hi = np.minimum(lo+1,n-1)
+    cum = np.cumsum(counts)
+    vLo = values[np.searchsorted(cum,lo,side='right')]
+    vHi = values[np.searchsorted(cum,hi,side='right')]
+    return(vLo+(h-lo)*(vHi-vLo))
+
+#median and iqr from a sketch
+def sketchMedianIqr(sketch):
+    q25, q50, q75 = sketchQuantiles(sketch,[0.25,0.5,0.75])
+    return(q50,q75-q25)
+
+#sketches of the real and imaginary parts of the normalized numerical dispersal vectors for a single pld, read from the store
+#chunkSize values at a time, so memory is bounded by the chunk rather than the size of the ensemble
+def numericalSketch(pld, alpha=0.005, chunkSize=2**20):
+    dist = loadDistances(pld) #(memory mapped)
+    cen = dist['centroids'].astype(complex)
+    numOffsets = dist['numOffsets']
+    skR = newSketch(alpha)
+    skI = newSketch(alpha)
+    for a in range(0,len(dist['numerical']),chunkSize):
+        num = np.asarray(dist['numerical'][a:a+chunkSize])
+        rec = np.searchsorted(numOffsets,np.arange(a,a+len(num)),side='right')-1 #ID record of each value
+        keep = (cen[rec]!=0)&~np.isnan(num) #ignore non-moving numerical drifters and nans, as in normalizedVectors
+        mArr = num[keep]/cen[rec[keep]]
+        addToSketch(skR,np.real(mArr))
+        addToSketch(skI,np.imag(mArr))
+    return(skR,skI)
+
+#median and iqr of the real and imaginary parts of normalized GDP dispersal, and iqr of normalized numerical dispersal
+#with sketch=True the numerical iqrs come from quantile sketches with relative error alpha (see numericalSketch)
+def pldStats(pld, sketch=False, alpha=0.005):
+    pArr, mArr = normalizedVectors(pld) if not sketch else (normalizedVectors(pld,numerical=False),None)
+    med_r, iqr_r = medianIqr(np.real(pArr).copy(),overwrite=True)
+    med_i, iqr_i = medianIqr(np.imag(pArr).copy(),overwrite=True)
+    if sketch:
+        skR, skI = numericalSketch(pld,alpha)
+        _, mIqr_r = sketchMedianIqr(skR)
+        _, mIqr_i = sketchMedianIqr(skI)
+        nNumerical = int(np.sum(skR['pos'])+np.sum(skR['neg'])+skR['zero'])
+    else:
+        _, mIqr_r = medianIqr(np.real(mArr).copy(),overwrite=True)
+        _, mIqr_i = medianIqr(np.imag(mArr).copy(),overwrite=True)
+        nNumerical = len(mArr)
+    return(dict(median_r=med_r,median_i=med_i,iqr_r=iqr_r,iqr_i=iqr_i,mIqr_r=mIqr_r,mIqr_i=mIqr_i,
+                nDrifters=len(pArr),nNumerical=nNumerical))
+
+#stats for every pld in pldArr, as arrays over pld - iqr_ratio is the ratio of GDP to numerical iqr (L_diff^obs/L_diff^m)
+def allPldStats(pldArr, sketch=False, alpha=0.005):
+    stats = [pldStats(pld,sketch,alpha) for pld in pldArr]
+    out = {var:np.array([x[var] for x in stats]) for var in stats[0]}
+    out['iqr_ratio'] = out['iqr_r']/out['mIqr_r']
+    out['iqr_ratio_i'] = out['iqr_i']/out['mIqr_i']
+    return(out)
+
+#---bootstrap---
+#confidence intervals for the median/iqr curves from resampling start IDs with replacement; each replicate draws as many IDs
+#as there are, and uses the GDP drifter and the full numerical ensemble of every ID drawn (counted as often as it is drawn)
+
+#linearly interpolated quantiles of each row of vals, ignoring nans (nan for rows without values)
+def rowQuantiles(vals, qs):
+    srt = np.sort(vals,axis=1) #(nans sort to the end)
+    n = np.sum(~np.isnan(vals),axis=1)
+    h = np.asarray(qs)[None,:]*np.maximum(n-1,0)[:,None]
+    lo = np.floor(h).astype(np.int64)
+    hi = np.minimum(lo+1,np.maximum(n-1,0)[:,None])
+    vLo = np.take_along_axis(srt,lo,axis=1)
+    vHi = np.take_along_axis(srt,hi,axis=1)
+    out = vLo+(h-lo)*(vHi-vLo)
+    out[n==0] = np.nan
+    return(out)
+
+#linearly interpolated quantiles of values, where each value (of ID rec) counts weights[row,rec] times, for every row of weights
+#values are sorted once, and each row's quantiles are found with a searchsorted on the cumulative weights; rows are done in
+#batches of about batchElems weights at a time
+def weightedRowQuantiles(values, rec, weights, qs, batchElems=2**24):
+    order = np.argsort(values,kind='stable')
+    srtVal = values[order]
+    srtRec = rec[order]
+    nRow, nVal = weights.shape[0], len(srtVal)
+    out = np.full((nRow,len(qs)),np.nan)
+    if nVal==0:
+        return(out)
+    batch = max(1,batchElems//nVal)
+    for b0 in range(0,nRow,batch):
+        cum = np.cumsum(weights[b0:b0+batch][:,srtRec],axis=1) #cumulative weight along the sorted values
+        nB = len(cum)
+        W = cum[:,-1]
+        h = np.asarray(qs)[None,:]*np.maximum(W-1,0)[:,None] #rank of each quantile
+        lo = np.floor(h).astype(np.int64)
+        hi = np.minimum(lo+1,np.maximum(W-1,0)[:,None])
+        #offset rows so every row can be searched at once (value with 0-based rank k is the first with cumulative weight > k)
+        big = int(np.amax(W))+1
+        rowOff = np.arange(nB,dtype=np.int64)[:,None]*big
+        flat = (cum+rowOff).ravel()
+        posLo = np.searchsorted(flat,(lo+rowOff).ravel(),side='right').reshape(lo.shape)-np.arange(nB)[:,None]*nVal
+        posHi = np.searchsorted(flat,(hi+rowOff).ravel(),side='right').reshape(hi.shape)-np.arange(nB)[:,None]*nVal
+        vLo = srtVal[np.minimum(posLo,nVal-1)]
+        res = vLo+(h-lo)*(srtVal[np.minimum(posHi,nVal-1)]-vLo)
+        res[W==0] = np.nan
+        out[b0:b0+nB] = res
+    return(out)
+
+#bootstrap replicates of the median/iqr stats for a single pld, returned as the ci percentiles over nRep replicates
+#seed is anything np.random.default_rng takes (bootstrapAll passes a SeedSequence per pld)
+def bootstrapPld(pld, nRep=1000, seed=None, ci=(2.5,97.5), batchElems=2**24):
+    rng = np.random.default_rng(seed)
+    pId, mArr, mRec = idVectors(pld)
+    nID = len(pId)
+    idx = rng.integers(0,nID,(nRep,nID)) #IDs drawn in each replicate (one row per replicate)
+
+    #GDP drifters - one value per ID drawn
+    pSamp = pId[idx]
+    qR = rowQuantiles(np.real(pSamp),[0.25,0.5,0.75])
+    qI = rowQuantiles(np.imag(pSamp),[0.25,0.5,0.75])
+
+    #numerical drifters - every value of an ID counts as often as the ID is drawn
+    weights = np.bincount((idx+np.arange(nRep)[:,None]*nID).ravel(),minlength=nRep*nID).reshape(nRep,nID)
+    mR = weightedRowQuantiles(np.real(mArr),mRec,weights,[0.25,0.75],batchElems)
+    mI = weightedRowQuantiles(np.imag(mArr),mRec,weights,[0.25,0.75],batchElems)
+
+    reps = dict(median_r=qR[:,1],median_i=qI[:,1],
+                iqr_ratio=(qR[:,2]-qR[:,0])/(mR[:,1]-mR[:,0]),
+                iqr_ratio_i=(qI[:,2]-qI[:,0])/(mI[:,1]-mI[:,0]))
+    return({var:np.nanpercentile(reps[var],ci) for var in reps})
+
+#bootstrap confidence bands for every pld in pldArr, with plds spread across nWorkers processes
+#returns arrays of shape (len(pldArr), 2) of the lower and upper bounds for median_r, median_i, iqr_ratio and iqr_ratio_i
+#each pld gets its own stream from SeedSequence(seed), so results don't depend on the number of workers
+def bootstrapAll(pldArr, nRep=1000, seed=0, ci=(2.5,97.5), nWorkers=None):
+    seeds = np.random.SeedSequence(seed).spawn(len(pldArr))
+    with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+        bands = list(pool.map(bootstrapPld,pldArr,[nRep]*len(pldArr),seeds,[ci]*len(pldArr)))
+    return({var:np.array([x[var] for x in bands]) for var in bands[0]})
+
+if __name__=='__main__':
+    #check partition-based quantiles against np.median and sps.iqr
+    if False:
+        import scipy.stats as sps
+        for n in [1,2,3,10,1001,100000]:
+            x = np.random.standard_cauchy(n)
+            med, iqr = medianIqr(x)
+            assert np.isclose(med,np.median(x)) and np.isclose(iqr,sps.iqr(x)), 'quantiles do not match for n=%s'%(n)
+        print('quantiles match np.median and sps.iqr')
+
+    #compare numerical iqrs from sketches with exact iqrs on the current dispersal vector store
+    #each sketch quartile interpolates between values within alpha (relative) of the values at the ranks either side of it,
+    #so it is within alpha*max(|lower value|,|upper value|) of the exact quartile
+    if False:
+        alpha = 0.005
+        for pld in np.arange(1,61):
+            _, mArr = normalizedVectors(pld)
+            skR, skI = numericalSketch(pld,alpha,chunkSize=100000)
+            for part, sk, name in [(np.real(mArr),skR,'real'),(np.imag(mArr),skI,'imag')]:
+                h = np.array([0.25,0.75])*(len(part)-1)
+                ranks = np.unique(np.r_[np.floor(h),np.minimum(np.floor(h)+1,len(part)-1)].astype(int))
+                srt = np.partition(part,ranks)
+                bound = alpha*np.maximum(np.abs(srt[np.floor(h).astype(int)]),np.abs(srt[np.minimum(np.floor(h)+1,len(part)-1).astype(int)]))
+                eq25, eq75 = quantiles(part,[0.25,0.75])
+                sq25, _, sq75 = sketchQuantiles(sk,[0.25,0.5,0.75])
+                assert np.all(np.abs([sq25-eq25,sq75-eq75])<=bound+1e-12), 'sketch quartiles outside error bound'
+                print('pld %s (%s): exact iqr %0.4f, sketch iqr %0.4f'%(pld,name,eq75-eq25,sq75-sq25))
+
+    #check batched bootstrap quantiles against expanding a few replicates explicitly, and time the full bootstrap for one pld
+    if False:
+        import time
+        pld = 30
+        pId, mArr, mRec = idVectors(pld)
+        rng = np.random.default_rng(1)
+        idx = rng.integers(0,len(pId),(5,len(pId)))
+        weights = np.array([np.bincount(row,minlength=len(pId)) for row in idx])
+        wq = weightedRowQuantiles(np.real(mArr),mRec,weights,[0.25,0.75],batchElems=len(mArr)*2)
+        rq = rowQuantiles(np.real(pId[idx]),[0.25,0.5,0.75])
+        for k in range(len(idx)):
+            expanded = np.concatenate([np.real(mArr[mRec==x]) for x in idx[k]])
+            assert np.allclose(wq[k],quantiles(expanded,[0.25,0.75])), 'weighted quantiles do not match'
+            pk = np.real(pId[idx[k]])
+            assert np.allclose(rq[k],quantiles(pk[~np.isnan(pk)],[0.25,0.5,0.75])), 'row quantiles do not match'
+        t1 = time.time()
+        band = bootstrapPld(pld,nRep=1000,seed=0)
+        print('1000 replicates for pld %s in %0.1fs: %s'%(pld,time.time()-t1,band))
@@ -0,0 +1,110 @@
+#Module for reading the GDP 6-hourly ragged array (gdp_jul22_ragged_6h.nc) in blocks of whole drifters using rowsize offsets
+#filters are applied to each block as it's read, so only observations that survive them are kept for the full archive
+import numpy as np
+import netCDF4 as nc
+
+dDir = None #path to directory where GDP data is saved
+dName = 'gdp_jul22_ragged_6h.nc' #GDP data name
+trajVars = ['ID','DrogueCenterDepth'] #variables with one value per drifter (repeated over its observations when read)
+
+def openGDP(fName=None):
+    if fName is None:
+        fName = dDir+dName
+    return(nc.Dataset(fName,'r'))
+
+#offsets into the observation arrays, where drifter k is obs[offsets[k]:offsets[k+1]]
+def rowOffsets(rowsize):
+    return(np.r_[0,np.cumsum(rowsize)].astype(np.int64))
+
+#drifter index and index along that drifter for global observation indices obs (e.g. index_in_drifter_array)
+def obsToDrifter(offsets, obs):
+    drIdx = np.searchsorted(offsets,obs,side='right')-1
+    return(drIdx,obs-offsets[drIdx])
+
+#observations of drifter k
+def drifterSlice(offsets, k):
+    return(slice(offsets[k],offsets[k+1]))
+
+#split drifters into blocks of about blockObs observations without splitting any drifter
+#returns a list of (first drifter, last drifter+1)
+def drifterBlocks(offsets, blockObs=2**22):
+    blocks = []
+    d0 = 0
+    nDr = len(offsets)-1
+    while d0<nDr:
+        d1 = np.searchsorted(offsets,offsets[d0]+blockObs,side='right')-1
+        d1 = min(max(d1,d0+1),nDr) #at least one drifter per block
+        blocks.append((d0,d1))
+        d0 = d1
+    return(blocks)
+
+#---filters - (column, predicate) pairs, where predicate returns a boolean mask for the column values of a block---
+#column can be any variable in the file, 'obs' (global observation index) or 'drifter' (drifter index)
+
+#drifters with drogues centered at dep (m)
+def drogueDepth(dep=15.):
+    return(('DrogueCenterDepth',lambda x: x==dep))
+
+#observations with attached drogues
+def drogueOn():
+    return(('drogue_status',lambda x: x.astype(bool)))
+
+#observations from the start of year onwards
+def fromYear(year=2007):
+    t0 = np.datetime64('%d-01-01'%(year),'s').astype(np.int64) #seconds since 1970
+    return(('time',lambda x: x>=t0))
+
+#observations over the shelf, where depth is the depth at every observation (as in drifter_depth_mask.npz)
+def onShelf(depth, maxDepth=-500.):
+    return(('obs',lambda obs: depth[obs]>=maxDepth))
+
+#read column var for drifters d0:d1 (observations o0:o1)
+def readColumn(trData, var, d0, d1, o0, o1, rowsize):
+    if var=='obs':
+        return(np.arange(o0,o1))
+    if var=='drifter':
+        return(np.repeat(np.arange(d0,d1),rowsize[d0:d1]))
+    if var in trajVars:
+        return(np.repeat(np.ma.getdata(trData[var][d0:d1]),rowsize[d0:d1]))
+    return(np.ma.getdata(trData[var][o0:o1]))
+
+#iterate over blocks of drifters, yielding a dict of columns for the observations that pass every filter (filters are
+#applied in order, and a block is skipped as soon as nothing in it survives)
+def iterBlocks(trData, columns=('ID','lon','lat','time'), filters=(), blockObs=2**22):
+    rowsize = np.ma.getdata(trData['rowsize'][:])
+    offsets = rowOffsets(rowsize)
+    for d0, d1 in drifterBlocks(offsets,blockObs):
+        o0, o1 = offsets[d0], offsets[d1]
+        keep = np.ones(o1-o0,dtype=bool)
+        for var, pred in filters:
+            keep &= pred(readColumn(trData,var,d0,d1,o0,o1,rowsize))
+            if not np.any(keep):
+                break
+        if not np.any(keep):
+            continue
+        yield({var:readColumn(trData,var,d0,d1,o0,o1,rowsize)[keep] for var in columns})
+
+#read the filtered columns for the whole archive
+def readFiltered(trData, columns=('ID','lon','lat','time'), filters=(), blockObs=2**22):
+    blocks = list(iterBlocks(trData,columns,filters,blockObs))
+    if len(blocks)==0:
+        return({var:np.zeros(0) for var in columns})
+    return({var:np.concatenate([block[var] for block in blocks]) for var in columns})
+
+if __name__=='__main__':
+    #check block reading against reading the full columns and masking (as in makeNumericalStartLocs.py)
+    if False:
+        import pandas as pd
+        depth = np.load('/home/willlush/workfiles/drifter_validation/drifter_depth_mask.npz')['depth']
+        trData = openGDP()
+        filters = [drogueDepth(15.),drogueOn(),fromYear(2007),onShelf(depth,-500.)]
+        cols = readFiltered(trData,columns=('ID','obs','lon','lat','time'),filters=filters,blockObs=2**20)
+
+        keepIds = trData['ID'][:][trData['DrogueCenterDepth'][:]==15.]
+        drIDArr = np.repeat(trData['ID'][:].data,trData['rowsize'][:].data)
+        bigMask = pd.to_datetime(trData['time'][:].data,unit='s').year>=2007
+        bigMask = bigMask & (depth>=-500.) & np.isin(drIDArr,keepIds) & trData['drogue_status'][:].data.astype(bool)
+        assert np.array_equal(cols['ID'],drIDArr[bigMask]), 'IDs do not match'
+        assert np.array_equal(cols['obs'],np.flatnonzero(bigMask)), 'observation indices do not match'
+        for var in ['lon','lat','time']:
+            assert np.array_equal(cols[var],trData[var][:].data[bigMask]), '%s does not match'%(var)
@@ -0,0 +1,106 @@
+#Module for nearest-neighbour lookups of grid points (e.g. the u and v points of the NEMO landmask), using kd-trees of 3d
+#points on the unit sphere - building the tree for a full NEMO grid takes most of a lookup, so the result of a query is saved
+#to indexDir for each named grid, and the tree is only built when a grid is queried with points it hasn't been queried with
+#also has the lon/lat to unit sphere conversion used by the numpy backend in particleTracking_core.py
+import numpy as np
+import os
+import hashlib
+from scipy.spatial import cKDTree
+from loadData import replaceFile #unique temporary file, then rename (uses loadData.py)
+
+indexDir = './gridIndex/' #directory where query results are saved
+
+#convert lon/lat to 3d points on the unit sphere
+def lonLatToXYZ(lon, lat):
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    return(np.stack([np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)],axis=-1))
+
+#hash of coordinates (and anything else in extra), to tell if a saved query was for the same grid and points
+def gridHash(lon, lat, *extra):
+    h = hashlib.sha1()
+    for arr in [lon,lat]+list(extra):
+        h.update(np.ascontiguousarray(arr,dtype=np.float64).tobytes())
+    return(h.hexdigest())
+
+#lookup for grid points lon, lat (any shape, flattened in C order) - a dict of the grid, its hash and the kd-tree, which is
+#built on the first query that isn't saved (see queryTree); with a name, query results are saved to indexDir under it
+def gridTree(lon, lat, name=None):
+    lon = np.ravel(lon)
+    lat = np.ravel(lat)
+    return({'lon':lon,'lat':lat,'hash':gridHash(lon,lat),'name':name,'tree':None})
+
+#kd-tree of a grid from gridTree, built once per process
+def buildTree(grid):
+    if grid['tree'] is None:
+        grid['tree'] = cKDTree(lonLatToXYZ(grid['lon'],grid['lat']))
+    return(grid['tree'])
+
+#indices (into the flattened grid) and chord distances of the k nearest grid points to lon, lat
+#points are queried chunkSize at a time (to bound memory), each chunk split across workers threads (-1 for all cores)
+#for a named grid, the last query is saved (indices, distances and a key for the grid, points and k - the key is written
+#last, so results from an interrupted save aren't used) and loaded instead of querying when the same points are asked for
+def queryTree(grid, lon, lat, k=2, chunkSize=2**20, workers=-1):
+    lon = np.ravel(lon)
+    lat = np.ravel(lat)
+    if grid['name'] is not None:
+        qName = indexDir+grid['name']
+        qKey = grid['hash']+gridHash(lon,lat,[k])
+        if os.path.exists(qName+'_query.txt'):
+            with open(qName+'_query.txt','r') as f:
+                if f.read().strip()==qKey:
+                    return(np.load(qName+'_dist.npy'),np.load(qName+'_ind.npy'))
+
+    tree = buildTree(grid)
+    dist = np.empty((len(lon),k))
+    ind = np.empty((len(lon),k),dtype=np.int64)
+    for c0 in range(0,len(lon),chunkSize):
+        cSl = slice(c0,c0+chunkSize)
+        d, i = tree.query(lonLatToXYZ(lon[cSl],lat[cSl]),k=k,workers=workers)
+        dist[cSl] = np.reshape(d,(-1,k))
+        ind[cSl] = np.reshape(i,(-1,k))
+
+    if grid['name'] is not None:
+        os.makedirs(indexDir,exist_ok=True)
+        replaceFile(qName+'_dist.npy',lambda f: np.save(f,dist))
+        replaceFile(qName+'_ind.npy',lambda f: np.save(f,ind))
+        replaceFile(qName+'_query.txt',lambda f: f.write(qKey.encode()))
+    return(dist,ind)
+
+#is any of the k nearest grid points to lon, lat wet (wet is a mask on the same grid)
+def wetWithin(grid, wet, lon, lat, k=2, chunkSize=2**20, workers=-1):
+    _, ind = queryTree(grid,lon,lat,k,chunkSize,workers)
+    return(np.any(np.ravel(wet)[ind],axis=1))
+
+#is there a u or v velocity on at least one of the k nearest u and v faces to lon, lat (e.g. a particle is not on land or
+#in water shallower than the drogue)
+def wetFace(uGrid, vGrid, uWet, vWet, lon, lat, k=2, chunkSize=2**20, workers=-1):
+    uEx = wetWithin(uGrid,uWet,lon,lat,k,chunkSize,workers)
+    vEx = wetWithin(vGrid,vWet,lon,lat,k,chunkSize,workers)
+    return(uEx|vEx)
+
+if __name__=='__main__':
+    #check kd-tree neighbours against brute-force great circle distances, and time a query that builds the tree against one
+    #that loads the saved result
+    if False:
+        import time
+        gLon, gLat = np.meshgrid(np.linspace(-180.,180.,360,endpoint=False),np.linspace(-80.,85.,165))
+        wet = np.random.random(gLon.shape)>0.4
+        pLon = np.random.uniform(-180.,180.,500)
+        pLat = np.random.uniform(-80.,85.,500)
+
+        t1 = time.time()
+        _, ind = queryTree(gridTree(gLon,gLat,name='test'),pLon,pLat,k=2,chunkSize=128)
+        tBuild = time.time()-t1
+        t1 = time.time()
+        grid = gridTree(gLon,gLat,name='test')
+        _, indSaved = queryTree(grid,pLon,pLat,k=2,chunkSize=128)
+        print('build and query: %0.2fs, load: %0.2fs'%(tBuild,time.time()-t1))
+        assert grid['tree'] is None and np.array_equal(ind,indSaved), 'saved query not used'
+
+        cosAng = lonLatToXYZ(pLon,pLat)@lonLatToXYZ(np.ravel(gLon),np.ravel(gLat)).T
+        bruteInd = np.argsort(-cosAng,axis=1)[:,:2]
+        assert np.array_equal(np.sort(ind,axis=1),np.sort(bruteInd,axis=1)), 'neighbours do not match'
+        assert np.array_equal(wetWithin(grid,wet,pLon,pLat,k=2),np.any(np.ravel(wet)[bruteInd],axis=1)), 'wet faces do not match'
+        _, indNew = queryTree(grid,pLon[::-1],pLat[::-1],k=2) #new points are queried, not loaded
+        assert grid['tree'] is not None and np.array_equal(indNew,ind[::-1]), 'new points not queried'
@@ -0,0 +1,81 @@
+#Module for grouping ID-sorted particle arrays (as returned by loadData) into segments of matching IDs, and for computing
+#per-ID quantities with segmented reductions instead of masking the full arrays once per ID
+import numpy as np
+
+#find segments of matching IDs in an ID-sorted array
+#returns the unique IDs and offsets, where segment k (ID unqIDs[k]) is arr[offsets[k]:offsets[k+1]]
+def segmentOffsets(idArr):
+    idArr = np.asarray(idArr)
+    if len(idArr)==0:
+        return(idArr[:0],np.zeros(1,dtype=np.int64))
+    assert np.all(idArr[1:]>=idArr[:-1]), 'IDs must be sorted (see sortByID)'
+    starts = np.flatnonzero(np.r_[True,idArr[1:]!=idArr[:-1]]) #first index of each segment
+    offsets = np.r_[starts,len(idArr)].astype(np.int64)
+    return(idArr[starts],offsets)
+
+#sort by ID (stable, so the order within each ID is kept) - returns the sorted IDs and the sorting index for other arrays
+def sortByID(idArr):
+    idSort = np.argsort(idArr,kind='stable')
+    return(np.asarray(idArr)[idSort],idSort)
+
+#number of elements in each segment
+def segmentCounts(offsets):
+    return(np.diff(offsets))
+
+#sum of values over each segment (segments must not be empty)
+def segmentSum(values, offsets):
+    return(np.add.reduceat(values,offsets[:-1],axis=0))
+
+#repeat one value per segment across the elements of that segment (e.g. for normalizing by a per-ID value)
+def segmentRepeat(values, offsets):
+    return(np.repeat(values,segmentCounts(offsets),axis=0))
+
+#calculating centroid location on sphere
+def getCentroid(lon,lat):
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+
+    x1 = np.cos(lat)*np.cos(lon)
+    y1 = np.cos(lat)*np.sin(lon)
+    z1 = np.sin(lat)
+
+    xa = np.mean(x1)
+    ya = np.mean(y1)
+    za = np.mean(z1)
+
+    cLon = np.arctan2(ya,xa)
+    hyp = np.sqrt((xa**2) + (ya**2))
+    cLat = np.arctan2(za,hyp)
+    return(np.degrees(cLon),np.degrees(cLat))
+
+#centroid on the sphere of every segment at once (same as getCentroid for each segment, but always summed in float64)
+def segmentCentroid(lon, lat, offsets):
+    lon = np.radians(np.asarray(lon,dtype=np.float64))
+    lat = np.radians(np.asarray(lat,dtype=np.float64))
+    xyz = np.stack([np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)],axis=1)
+    xa, ya, za = (segmentSum(xyz,offsets)/segmentCounts(offsets)[:,None]).T
+
+    cLon = np.arctan2(ya,xa)
+    hyp = np.sqrt((xa**2) + (ya**2))
+    cLat = np.arctan2(za,hyp)
+    return(np.degrees(cLon),np.degrees(cLat))
+
+if __name__=='__main__':
+    #check segmentCentroid against getCentroid with a per-ID loop, and time both
+    if False:
+        import time
+        nIDs = 5000
+        idArr = np.sort(np.random.randint(0,nIDs,200000))
+        lonArr = np.random.uniform(-180.,180.,len(idArr))
+        latArr = np.random.uniform(-80.,80.,len(idArr))
+
+        t1 = time.time()
+        loopCen = np.array([getCentroid(lonArr[idArr==trID],latArr[idArr==trID]) for trID in np.unique(idArr)])
+        tLoop = time.time()-t1
+        t1 = time.time()
+        unqIDs, offsets = segmentOffsets(idArr)
+        segCen = np.array(segmentCentroid(lonArr,latArr,offsets)).T
+        tSeg = time.time()-t1
+        assert np.array_equal(unqIDs,np.unique(idArr)), 'segment IDs do not match'
+        assert np.allclose(loopCen,segCen,rtol=0.,atol=1e-9), 'centroids do not match'
+        print('per-ID loop: %0.2fs, segments: %0.3fs'%(tLoop,tSeg))
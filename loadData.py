@@ -1,39 +1,171 @@
 #Module to load some necessary data - loads starts, ID dictionaries, and trajectory starts/endpoints (for a given drifter duration)
+#also saves/loads the dispersal vector store written by precomputeDistance.py
 import numpy as np
 import pylab as p
 import netCDF4 as nc
-import zarr, pickle
+import zarr, json
+import os
+import tempfile
 
-#funtion to load t-points and mask, as well as start location-ID mapping dicts
-def loadGrid(return_starts=False):
-    #load grid cell center (t-point) locations
-    maskName = '/data/guppy2/willlush/Mercator/cGrid/MeshFiles/ext-PSY4V3R1_mask.nc'
+trajDir = None #where processed trajectories are stored...
+startName = './startPosition_idDicts.npz' #start location-ID dicts
+
+maskName = '/data/guppy2/willlush/Mercator/cGrid/MeshFiles/ext-PSY4V3R1_mask.nc' #NEMO mask file
+gridCacheDir = None #where the grid is cached as .npy files (None for next to the mask file)
+gridCache = {} #grid and start dicts already loaded by this process
+
+#directory of the .npy grid cache for maskName
+def gridCacheName():
+    cacheDir = gridCacheDir if gridCacheDir is not None else os.path.dirname(maskName)+'/'
+    return(cacheDir+os.path.splitext(os.path.basename(maskName))[0]+'_gridCache/')
+
+#key for the cache - size and modification time of the mask file
+def gridKey():
+    fStat = os.stat(maskName)
+    return({'source':os.path.abspath(maskName),'size':fStat.st_size,'mtime':fStat.st_mtime_ns})
+
+#write fName through write(f) on a uniquely named temporary file in the same directory, then rename it - processes caching
+#at the same time don't write to each other's files, and a partly written file is never left under fName
+def replaceFile(fName, write):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(fName),prefix=os.path.basename(fName)+'.',delete=False) as f:
+        try:
+            write(f)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name,fName)
+
+#convert t-points and mask from the NEMO mask file to .npy files (key written last, so an interrupted write isn't used)
+def cacheGrid(cName):
+    os.makedirs(cName,exist_ok=True)
     lMask = nc.Dataset(maskName,'r')
-    tMask = np.ravel(lMask['tmask'][0,0,:,:].data.astype(bool)) #mask
-    tLon = np.ravel(lMask['nav_lon'][:].data) #longitude of t-point
-    tLat = np.ravel(lMask['nav_lat'][:].data) #latitude of t-point
+    gridVars = {'tMask':np.ravel(lMask['tmask'][0,0,:,:].data.astype(bool)), #mask
+                'tLon':np.ravel(lMask['nav_lon'][:].data), #longitude of t-point
+                'tLat':np.ravel(lMask['nav_lat'][:].data)} #latitude of t-point
     lMask.close() #close netcdf file
-    
+    for var in gridVars:
+        replaceFile(cName+var+'.npy',lambda f: np.save(f,gridVars[var]))
+    replaceFile(cName+'gridKey.json',lambda f: f.write(json.dumps(gridKey()).encode()))
+
+#funtion to load t-points and mask, as well as start location-ID mapping dicts
+#the grid is converted from the mask file to .npy files once (redone if the mask file changes), then memory mapped
+#(read-only, and shared between processes), and kept for later calls in the same process
+def loadGrid(return_starts=False):
+    if 'grid' not in gridCache:
+        cName = gridCacheName()
+        try:
+            with open(cName+'gridKey.json','r') as f:
+                cached = json.load(f)==gridKey()
+        except (OSError,ValueError):
+            cached = False
+        if not cached:
+            print('caching grid from %s in %s'%(maskName,cName))
+            cacheGrid(cName)
+        gridCache['grid'] = tuple(np.load(cName+var+'.npy',mmap_mode='r') for var in ['tMask','tLon','tLat'])
+    tMask, tLon, tLat = gridCache['grid']
+
     if return_starts==True: #load starting location-ID dicts
-        #starting location dicts
-        dName = './' #directory where start/id dicts are located
-        loadStarts = np.load(dName+'startPosition_idDicts.npz',allow_pickle=True)
-        st2id = loadStarts['start2id'].item() #dict to go from start to ID
-        id2st = loadStarts['id2start'].item() #dict to go from ID to start
+        st2id, id2st = loadStarts()
         return(tMask,tLon,tLat,st2id,id2st)
     else:
         return(tMask,tLon,tLat)
 
+#function to load the start location-ID mapping dicts only (kept for later calls in the same process)
+def loadStarts():
+    if gridCache.get('startName')!=startName:
+        loadStarts = np.load(startName,allow_pickle=True)
+        st2id = loadStarts['start2id'].item() #dict to go from start to ID
+        id2st = loadStarts['id2start'].item() #dict to go from ID to start
+        gridCache['starts'] = (st2id,id2st)
+        gridCache['startName'] = startName
+    return(gridCache['starts'])
+
+#name of the processed trajectory endpoints for a given drifter duration
+def trajName(pld):
+    return(trajDir+'particlePositions_pld%02d.nc'%(pld))
+
 #function to load trajectory endpoints after a given drifter duration
 #pld in code is simply drifter duration, stands for pelagic larval duration
 def loadData(pld):
     #load trajectory endpoints
-    trajDict = None #where processed trajectories are stored...
-    trajName = 'particlePositions_pld%02d.nc'%(pld) #processed trajectory name
-    tName = trajDict+trajName
+    tName = trajName(pld) #processed trajectory name
     lTraj = nc.Dataset(tName,'r')
     idArr = lTraj['idArr'][:].data #get IDs from .nc file
     lonArr = lTraj['lonArr'][:].data #get lons from .nc file
     latArr = lTraj['latArr'][:].data #get lats from .nc file
     lTraj.close() #close netcdf file
     return(idArr,lonArr,latArr)
+
+#---simplified GDP trajectory store---
+#simplified GDP trajectories from simpleDrifterTraj.py are stored column-wise as .npy files in a directory (no pickles, so
+#they can be memory mapped): lon, lat, time (s) and age (s) of all segments concatenated, where segment k is
+#[offsets[k]:offsets[k+1]], and startLon, startLat and traj (GDP drifter ID) with one value per segment
+trajStoreName = 'trajStore_04_04_24/' #where simplified GDP trajectories are stored
+trajStoreVars = ['lon','lat','time','age','offsets','startLon','startLat','traj']
+
+#save simplified GDP trajectories in the layout above (counts is the number of points in each segment)
+#start locations default to the first point of each segment
+def saveTrajectories(lon, lat, time, age, counts, traj, startLon=None, startLat=None, dName=trajStoreName):
+    os.makedirs(dName,exist_ok=True)
+    offsets = np.r_[0,np.cumsum(counts)].astype(np.int64)
+    if startLon is None:
+        startLon = np.asarray(lon)[offsets[:-1]]
+        startLat = np.asarray(lat)[offsets[:-1]]
+    columns = {'lon':np.asarray(lon),
+               'lat':np.asarray(lat),
+               'time':np.asarray(time),
+               'age':np.asarray(age),
+               'offsets':offsets,
+               'startLon':np.asarray(startLon), #start location of each segment
+               'startLat':np.asarray(startLat),
+               'traj':np.asarray(traj)}
+    for var in trajStoreVars:
+        np.save(dName+var+'.npy',columns[var])
+
+#load simplified GDP trajectories as a dict of memory mapped columns (see layout above)
+def loadTrajectories(dName=trajStoreName):
+    return({var:np.load(dName+var+'.npy',mmap_mode='r') for var in trajStoreVars})
+
+#---dispersal vector store---
+#dispersal vectors from precomputeDistance.py are stored column-wise as .npy files in a directory, one record per (pld, ID),
+#sorted by pld and then ID: pld, ID, centroids and drifters (complex64) have one value per record, the numerical ensemble of
+#record k is numerical[numOffsets[k]:numOffsets[k+1]], and the records for a given pld are pldOffsets[pld]:pldOffsets[pld+1]
+distName = 'drifterDistances_6_24_24/' #where dispersal vectors are stored
+distStoreVars = ['pld','ID','centroids','drifters','numerical','numOffsets','pldOffsets'] #.npy files in the store
+
+#save dispersal vectors in the layout above (numCounts is the size of the numerical ensemble for each record)
+def saveDistances(pldArr, idArr, centroids, drifters, numerical, numCounts, dName=distName):
+    os.makedirs(dName,exist_ok=True)
+    pldArr = np.asarray(pldArr,dtype=np.int16)
+    idArr = np.asarray(idArr,dtype=np.int32)
+    order = np.lexsort((idArr,pldArr))
+    numCounts = np.asarray(numCounts,dtype=np.int64)
+    numOffsets = np.r_[0,np.cumsum(numCounts)]
+    #reorder numerical ensembles along with the records
+    newOffsets = np.r_[0,np.cumsum(numCounts[order])]
+    numIdx = np.arange(newOffsets[-1])+np.repeat(numOffsets[order]-newOffsets[:-1],numCounts[order])
+    pldArr = pldArr[order]
+    np.save(dName+'pld.npy',pldArr)
+    np.save(dName+'ID.npy',idArr[order])
+    np.save(dName+'centroids.npy',np.asarray(centroids,dtype=np.complex64)[order])
+    np.save(dName+'drifters.npy',np.asarray(drifters,dtype=np.complex64)[order])
+    np.save(dName+'numerical.npy',np.asarray(numerical,dtype=np.complex64)[numIdx])
+    np.save(dName+'numOffsets.npy',newOffsets)
+    np.save(dName+'pldOffsets.npy',np.searchsorted(pldArr,np.arange(0,62)).astype(np.int64))
+
+#load dispersal vectors for a single pld (optionally only IDs idMin <= ID < idMax) from the store, memory mapped
+#returns a dict of ID, centroids, drifters (one per ID), numerical (all ensembles) and numOffsets (ensemble of the k-th ID is
+#numerical[numOffsets[k]:numOffsets[k+1]]) - everything but numOffsets is a view into the files, so only the slice is read
+def loadDistances(pld, idRange=None, dName=distName):
+    pldOffsets = np.load(dName+'pldOffsets.npy')
+    a, b = pldOffsets[pld], pldOffsets[pld+1]
+    ids = np.load(dName+'ID.npy',mmap_mode='r')
+    if idRange is not None:
+        a, b = a+np.searchsorted(ids[a:b],idRange[0]), a+np.searchsorted(ids[a:b],idRange[1])
+    numOffsets = np.load(dName+'numOffsets.npy',mmap_mode='r')[a:b+1]
+    return({'ID':ids[a:b],
+            'centroids':np.load(dName+'centroids.npy',mmap_mode='r')[a:b],
+            'drifters':np.load(dName+'drifters.npy',mmap_mode='r')[a:b],
+            'numerical':np.load(dName+'numerical.npy',mmap_mode='r')[numOffsets[0]:numOffsets[-1]],
+            'numOffsets':np.asarray(numOffsets)-numOffsets[0]})
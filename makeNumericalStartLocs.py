@@ -6,25 +6,28 @@ import zarr
 import netCDF4 as nc
 import pandas as pd
 from tqdm import tqdm
-from sklearn.neighbors import BallTree,NearestNeighbors
+from groupByID import segmentOffsets, segmentRepeat
+import gdpRagged as gdp
+import gridIndex as gi
 import cartopy.crs as ccrs
 import cartopy
 
-#load GDP data
-dDir = None #path to directory where GDP data is saved
-dName = 'gdp_jul22_ragged_6h.nc' #GDP data name
-trData = nc.Dataset(dDir+dName,'r')
-drifterNoList = trData['ID'][:].data #drifter numbers
-drifterIDs = np.arange(len(drifterNoList)) #local drifter IDs
-keepIds = trData['ID'][:][trData['DrogueCenterDepth'][:]==15.] #select only drifters with 15m drogues
-drogueOn = trData['drogue_status'][:].data.astype(bool) #select only drifters with attached drogues
-rowSizeList = trData['rowsize'][:].data #rowsize, for data access from ragged array
-unqIDs = np.arange(len(drogueOn)) #IDs for drifters with attached drogues
-
 #load depth array, for selecting drifter locations on the shelf
 depthDir = '/home/willlush/workfiles/drifter_validation/'
 depth = np.load(depthDir+'drifter_depth_mask.npz')['depth']
-shallower = depth>=-500. #shallower than 500m (~over shelf)
+
+#load GDP data in blocks of drifters (uses gdpRagged.py), keeping only drifters on the shelf (shallower than 500m), after
+#2007, with attached drogues, and with drogues at 15m
+gdp.dDir = None #path to directory where GDP data is saved
+trData = gdp.openGDP()
+filters = [gdp.drogueDepth(15.),gdp.drogueOn(),gdp.fromYear(2007),gdp.onShelf(depth,-500.)]
+gdpCols = gdp.readFiltered(trData,columns=('ID','obs','lon','lat','time'),filters=filters)
+drIDArr = gdpCols['ID'] #drifter numbers
+dr_lon = gdpCols['lon']
+dr_lat = gdpCols['lat']
+dr_time = gdpCols['time']
+readTime = pd.to_datetime(dr_time,unit='s')
+uId = gdpCols['obs'] #index in full drifter array
 
 #load landmask, for preventing stuck drifters
 lmDir = '/home/willlush/workfiles/drifter_validation/particle_tracking/'
@@ -32,58 +35,18 @@ lm = np.load(lmDir+'depth_avg_landMask.npz')
 uM = np.ravel(lm['uMask']) #u mask
 vM = np.ravel(lm['vMask']) #v mask
 
-#make map of nearest neighbors for fast lookup of u and v locations (to avoid 'beached' particles)
-uLocs = np.radians(list(zip(np.ravel(lm['uLat']),np.ravel(lm['uLon']))))
-vLocs = np.radians(list(zip(np.ravel(lm['vLat']),np.ravel(lm['vLon']))))
-uN = NearestNeighbors(n_neighbors=2, algorithm='ball_tree').fit(uLocs)
-vN = NearestNeighbors(n_neighbors=2, algorithm='ball_tree').fit(vLocs)
-
-#make drifter ID full length of trajectory array
-drIDArr = []
-for ix in np.arange(len(drifterNoList)):
-    sh = rowSizeList[ix]
-    drIDArr.extend(np.full(sh,drifterNoList[ix]))
-drIDArr = np.array(drIDArr)
-#make a mask to keep IDs where the drogue is on and is centered at 15m
-drIDmask = np.isin(drIDArr,keepIds)
-
-#extract lat, lon, and time from GDP drifter data
-dr_lon = trData['lon'][:].data
-dr_lat = trData['lat'][:].data
-dr_time = trData['time'][:].data
-
-#make mask for all times after 2007 (excliude old drifters)
-readTime = pd.to_datetime(dr_time,unit='s')
-timeMask = readTime.year>=2007
-
-#combine masks to ensure drifters included are on the shelf, after 2007, have attached drogues, and drogues are 15m
-depthMask = shallower
-bigMask = timeMask & depthMask
-bigMask = bigMask & drIDmask
-bigMask = bigMask & drogueOn
-
-#apply masks to arrays
-drIDArr = drIDArr[bigMask]
-dr_lon = dr_lon[bigMask]
-dr_lat = dr_lat[bigMask]
-dr_time = dr_time[bigMask]
-readTime = readTime[bigMask]
-uId = unqIDs[bigMask]
+#lookups of u and v locations (to avoid 'beached' particles) - the neighbours of the drifter positions are saved for the
+#landmask grid, so the kd-trees are only built when the grid or the positions change (uses gridIndex.py)
+gi.indexDir = lmDir
+uGrid = gi.gridTree(lm['uLon'],lm['uLat'],name='depth_avg_landMask_u')
+vGrid = gi.gridTree(lm['vLon'],lm['vLat'],name='depth_avg_landMask_v')
 
-#make arrays of neighboring points for all lats and lons
-dLocs = np.radians(list(zip(dr_lat,dr_lon)))
+#ensure velocities exist on nearest grid cell walls - e.g. particle is not started on land or in water shallower than drogue length
+#(is there a u or v velocity on at least one side?)
 print('starting neighbor search')
-uD, uInd = uN.kneighbors(dLocs)
-vD, vInd = vN.kneighbors(dLocs)
+deep = gi.wetFace(uGrid,vGrid,uM,vM,dr_lon,dr_lat,k=2)
 print('done')
 
-#ensure velocities exist on nearest grid cell walls - e.g. particle is not started on land or in water shallower than drogue length
-uEx = np.any(uM[uInd],axis=1) #is there a u velocity on at least one side?
-vEx = np.any(vM[vInd],axis=1) #is there a v velocity on at least one side?
-
-#make mask from above
-deep = uEx|vEx
-
 #apply mask
 drIDArr = drIDArr[deep]
 dr_lon = dr_lon[deep]
@@ -92,45 +55,63 @@ dr_time = dr_time[deep]
 readTime = readTime[deep]
 uId = uId[deep]
 
-#loop to get start positions
+#find start positions separated by at least sep along each trajectory, for all trajectories at once
+#from the first time on each trajectory, repeatedly jump to the first time at least sep later, while the current time + sep
+#is before the last time on the trajectory (so there will always be at least sep between starting points, even if the
+#trajectory is discontinuous, e.g. exits and re-enters the shelf) - trajectories with a single point get no start positions
+#drID is the drifter of each point, tArr int64 times (seconds) and sep the separation in the same units
+#returns indices into drID, ordered by drifter and then by index (same order as looping over np.unique(drID))
+def selectStarts(drID, tArr, sep):
+    tArr = np.asarray(tArr,dtype=np.int64)
+    order = np.lexsort((tArr,drID)) #sort by drifter, then by time
+    unqDr, offsets = segmentOffsets(drID[order])
+    seg = segmentRepeat(np.arange(len(unqDr)),offsets) #segment of each sorted point
+    tSort = tArr[order]-tArr.min() #time since first point
+    tMax = tSort[offsets[1:]-1] #last time on each trajectory
+    #search key increasing along the sorted points (segments spaced further apart than any time + sep)
+    span = np.int64(tSort.max())+np.int64(sep)+1
+    key = seg*span+tSort
+
+    cur = offsets[:-1].copy() #current start index on each trajectory (first time)
+    active = np.flatnonzero(tSort[cur]<tMax)
+    stSort = []
+    while len(active)>0:
+        stSort.append(cur[active])
+        tc = tSort[cur[active]]+sep #advance by sep
+        keep = tc<tMax[active] #stop once past the end of the trajectory
+        active = active[keep]
+        tc = tc[keep]
+        cur[active] = np.searchsorted(key,active*span+tc,side='left') #first time >= tc on each trajectory
+    stSort = np.concatenate(stSort) if len(stSort)>0 else np.zeros(0,dtype=np.int64)
+    stInd = order[stSort]
+    return(stInd[np.lexsort((stInd,seg[stSort]))])
+
+#get start positions
 dayDiff = 10. #minimum separation of points on each trajectory
-#empty lists to save data
-stLon = []
-stLat = []
-stID = []
-stTime = []
-tAfter = []
-whichDrifters = []
-for dr in tqdm(np.unique(drIDArr)):
-    td = pd.Timedelta(days=dayDiff) #convert dayDiff into Timedelta object
-    idMask = drIDArr==dr #mask to look only at a single trajectory (by ID)
-    #apply mask
-    whichID = uId[idMask]
-    idLon = dr_lon[idMask]
-    idLat = dr_lat[idMask]
-    idTime = dr_time[idMask]
-    rTime = readTime[idMask]
-    #find minimum and maximum date/time along trajectory
-    minTime = np.amin(rTime)
-    maxTime = np.amax(rTime)
-    tc = minTime #time value used to loop over trajectory
-    stInd = []
-    #loop over trajectory to ensure starting locations are at least 10 days apart
-    while tc<maxTime:
-        #this loop finds the index of the smallest value of time along the trajectory, with a minimum 10-day separation between iterations (enforce by tc) - this ensures that there will always be at least a 10-day separation between starting points, even if the trajectory is discontinuous (e.g. exits and re-enters the shelf)
-        tDiff = rTime-tc #time elapsed along trajectory
-        gThan = tDiff>=pd.Timedelta(seconds=0) #look only at current and future times (along trajectory)
-        minGT = np.amin(rTime[gThan]) #smallest time considered
-        localInd = np.argwhere(rTime==minGT).item() #index of smallest time
-        stInd.append(localInd) #append starting index to start Index 
-        tc = rTime[localInd]+td #advance tc value by 10 days
-    if len(stInd)>0: #use starting indices to create a list of starting lats, lons, IDs, and times (time is when the GDP drifter transited a given point)
-        stInd = np.unique(stInd)
-        stLon.extend(idLon[stInd])
-        stLat.extend(idLat[stInd])
-        stID.extend(whichID[stInd])
-        stTime.extend(rTime[stInd])
-        
+tSec = readTime.asi8//10**9 #int64 times (seconds)
+stInd = selectStarts(drIDArr,tSec,int(dayDiff*86400))
+#starting lats, lons, IDs, and times (time is when the GDP drifter transited a given point)
+stLon = list(dr_lon[stInd])
+stLat = list(dr_lat[stInd])
+stID = list(uId[stInd])
+stTime = list(readTime[stInd])
+
+#check selectStarts against looping over each trajectory
+if False:
+    td = pd.Timedelta(days=dayDiff)
+    loopInd = []
+    for dr in tqdm(np.unique(drIDArr)):
+        idInd = np.flatnonzero(drIDArr==dr)
+        rTime = readTime[idInd]
+        tc = np.amin(rTime)
+        drInd = []
+        while tc<np.amax(rTime):
+            localInd = np.argwhere(rTime==np.amin(rTime[rTime-tc>=pd.Timedelta(seconds=0)])).item()
+            drInd.append(localInd)
+            tc = rTime[localInd]+td
+        loopInd.extend(idInd[np.unique(drInd).astype(int)])
+    assert np.array_equal(loopInd,stInd), 'start positions do not match'
+
 if True: #save starting positions as .npz file
     print('saving')
     saveDir = None #where to save particle start positions
@@ -6,6 +6,12 @@ import pandas as pd
 import datetime as dtm
 import xarray as xr
 import time
+import math
+import os
+import shutil
+import glob
+from scipy.spatial import cKDTree
+from gridIndex import lonLatToXYZ #lon/lat to 3d points on the unit sphere (uses gridIndex.py)
 from parcels import AdvectionRK4, FieldSet, JITParticle, Variable, ParticleFile, ParticleSet, ScipyParticle, ErrorCode
 
 #Data location
@@ -30,23 +36,88 @@ variables = {'U': 'uAvg',
              'V': 'vAvg'}
 dimensions = {'lon': 'glamf', 'lat': 'gphif','time': 'time'}
 
-#core function to track particles using Parcels
-def track_particles(release_lon, release_lat, release_time, duration, output_frequency, outFile):
-    #get first release in startlist
-    firstRelease = np.amin(release_time)
-    print(firstRelease) #print the first release
-    lastRelease = np.amax(release_time) #get final release time
-    #make timedelta object between first and last releases, with added duration of tracking
-    t_diff = pd.Timedelta(lastRelease-firstRelease).total_seconds()+pd.Timedelta(days=duration).total_seconds()
-    
-    #make fieldset from grid using Parcels
-    print('making fieldset')
-    fSet = FieldSet.from_nemo(filenames, variables, dimensions, chunksize = 'auto', allow_time_extrapolation=True)
-    print('done with fieldset')
-    
+#upper bound on depth-averaged drifter speed (m/s), used to size the margin around release positions when subsetting the grid
+maxTravelSpeed = 0.5
+
+#velocity filenames for a single year
+def year_files(year):
+    return(dataDir+'depthAvg_6mDrogue_15mCenter_%s_u.nc'%(year),dataDir+'depthAvg_6mDrogue_15mCenter_%s_v.nc'%(year))
+
+#load f-point (cell corner) longitudes and latitudes of the NEMO grid
+def load_fpoints():
+    grd = xr.open_dataset(gridFile)
+    glamf = np.squeeze(grd['glamf'].values)
+    gphif = np.squeeze(grd['gphif'].values)
+    grd.close()
+    return(glamf,gphif)
+
+#index window on the NEMO grid covering a lon/lat box, in the form Parcels takes for indices
+#bbox is (lonMin, lonMax, latMin, latMax); if not given, it is the box around the release positions plus the distance a
+#particle could travel in duration days at maxTravelSpeed (or margin_km if given)
+def domain_indices(release_lon, release_lat, duration, bbox=None, margin_km=None):
+    if bbox is None:
+        if margin_km is None:
+            margin_km = maxTravelSpeed*duration*86400./1000.
+        dLat = margin_km/111.12 #km to degrees latitude
+        latMin = max(np.amin(release_lat)-dLat,-90.)
+        latMax = min(np.amax(release_lat)+dLat,90.)
+        cosLat = np.cos(np.radians(max(abs(latMin),abs(latMax)))) #widest longitude margin is at the poleward edge
+        dLon = margin_km/(111.12*max(cosLat,1e-3))
+        bbox = (np.amin(release_lon)-dLon,np.amax(release_lon)+dLon,latMin,latMax)
+    lonMin, lonMax, latMin, latMax = bbox
+
+    glamf, gphif = load_fpoints()
+    latIn = (gphif>=latMin)&(gphif<=latMax)
+    if lonMax-lonMin>=360.:
+        lonIn = np.ones(glamf.shape,dtype=bool)
+    else:
+        lonIn = np.mod(glamf-lonMin,360.)<=(lonMax-lonMin) #handles boxes that cross the dateline
+    jj, ii = np.nonzero(latIn&lonIn)
+    if len(jj)==0:
+        return(None)
+
+    #pad by one cell so particles at the edge of the box still have a full cell around them
+    #(a box across the grid seam spans the whole x range, which is still correct, just not smaller)
+    j0 = max(np.amin(jj)-1,0)
+    j1 = min(np.amax(jj)+2,glamf.shape[0])
+    i0 = max(np.amin(ii)-1,0)
+    i1 = min(np.amax(ii)+2,glamf.shape[1])
+    print('grid subset: y %s:%s, x %s:%s of %s'%(j0,j1,i0,i1,glamf.shape))
+    return({'lon':range(i0,i1),'lat':range(j0,j1)})
+
+#make fieldset from grid using Parcels - uFiles/vFiles restrict the data files that are read (default is every year)
+#and indices restricts the part of the grid that is read (default is the global grid)
+def make_fieldset(uFiles=None, vFiles=None, indices=None):
+    fNames = {'U': dict(filenames['U']),
+              'V': dict(filenames['V'])}
+    if uFiles is not None:
+        fNames['U']['data'] = uFiles
+        fNames['V']['data'] = vFiles
+    fSet = FieldSet.from_nemo(fNames, variables, dimensions, indices=indices, chunksize = 'auto', allow_time_extrapolation=True)
+    return(fSet)
+
+#yearly files needed to cover tStart to tEnd
+#pad by a day on each side so the first/last daily time slice of the neighbouring year is available for time interpolation
+def window_files(tStart, tEnd):
+    years = np.arange((pd.Timestamp(tStart)-pd.Timedelta(days=1)).year,(pd.Timestamp(tEnd)+pd.Timedelta(days=1)).year+1)
+    fList = [year_files(yr) for yr in years]
+    fList = [x for x in fList if os.path.exists(x[0])] #drop years that don't exist (e.g. past the end of the data)
+    uFiles = [x[0] for x in fList]
+    vFiles = [x[1] for x in fList]
+    return(uFiles,vFiles)
+
+#track one set of particles through a given fieldset with Parcels and write the trajectories to outFile
+#with output_mode='endpoints' nothing is written; the positions at integer-day ages are returned instead (see sample_endpoints)
+#release_id is the start position ID of each particle, written once per trajectory (-1 if not given)
+def run_particleset(fSet, release_lon, release_lat, time_release, duration, output_frequency, outFile, output_mode='trajectory', release_id=None):
+    #runtime between first and last releases, with added duration of tracking
+    t_diff = pd.Timedelta(np.amax(time_release)-np.amin(time_release)).total_seconds()+pd.Timedelta(days=duration).total_seconds()
+
     #define a particle class where particles have a defined age
     class AgeParticle(JITParticle):
         age=Variable('age',initial=0.,dtype=np.float32)
+        pindex=Variable('pindex',dtype=np.int32,to_write=False) #position in the release arrays
+        ID=Variable('ID',initial=-1,dtype=np.int32,to_write='once') #start position ID
         
     #add a kernel that kills the particle after durationDays
     fSet.add_constant('maxage',pd.Timedelta(days=duration).total_seconds())
@@ -61,26 +132,467 @@ def track_particles(release_lon, release_lat, release_time, duration, output_fre
         print('deleting...')
         particle.delete()
 
-    #get release times in proper datetime64 format
-    time_release = np.array([np.datetime64(x)for x in release_time])
-
     #create particleset
     print('making particleset')
     pSet=ParticleSet.from_list(fieldset=fSet,pclass=AgeParticle,lon=np.array(release_lon),
-                               lat=np.array(release_lat),time=np.array(time_release))
+                               lat=np.array(release_lat),time=np.array(time_release),
+                               pindex=np.arange(len(release_lon),dtype=np.int32),ID=get_ids(release_id,len(release_lon)))
     print('done with particleset')
 
-    #create particle output file and chunking (for performance - machine dependent)
-    outFile=pSet.ParticleFile(name=outFile,outputdt=dtm.timedelta(hours=output_frequency),chunks=(2200,40))
-
     #make SampleAge into a kernel object
     k_SampleAge=pSet.Kernel(SampleAge)
 
+    if output_mode=='endpoints':
+        #execute one output interval at a time and keep only particles that are at an integer-day age
+        outDt = pd.Timedelta(hours=output_frequency).total_seconds()
+        kernels = pSet.Kernel(AdvectionRK4)+k_SampleAge
+        endpoints = []
+        tEnd = np.amax(pSet.time)+pd.Timedelta(days=duration).total_seconds() #in fieldset time
+        while len(pSet)>0 and np.amin(pSet.time)<tEnd: #(a gap in releases skips ahead to the next release)
+            pSet.execute(kernels,endtime=min(np.amin(pSet.time)+outDt,tEnd),dt=pd.Timedelta(minutes=60.0).total_seconds(),verbose_progress=False,recovery={ErrorCode.ErrorOutOfBounds: DeleteParticle})
+            endpoints.append(sample_endpoints(pSet.pindex,pSet.age,pSet.lon,pSet.lat,duration))
+        return(concat_endpoints(endpoints))
+
+    #create particle output file and chunking (for performance - machine dependent)
+    outFile=pSet.ParticleFile(name=outFile,outputdt=dtm.timedelta(hours=output_frequency),chunks=(2200,40))
+
     #track particles using Parcels, if particle runs out of bounds, delete
     pSet.execute(AdvectionRK4+k_SampleAge,runtime=t_diff,dt=pd.Timedelta(minutes=60.0).total_seconds(),output_file=outFile,verbose_progress=True,recovery={ErrorCode.ErrorOutOfBounds: DeleteParticle})
-    print('done with execution in %ss'%(time.time()-t1))
     outFile.close()
 
+#start position IDs as int32, -1 where no IDs were given
+def get_ids(release_id, nPart):
+    if release_id is None:
+        return(np.full(nPart,-1,dtype=np.int32))
+    release_id = np.asarray(release_id,dtype=np.int32)
+    assert len(release_id)==nPart, 'release_id and release positions do not correspond'
+    return(release_id)
+
+#---endpoint output---
+#instead of full trajectories, only the positions at ages of 1, 2, ..., duration days are kept (what trajByDuration.py uses),
+#as columns of particle index (into the release arrays), pld (age in days), lon and lat
+
+#endpoint columns for the particles in pindex that are at an integer-day age
+def sample_endpoints(pindex, age, lon, lat, duration):
+    age = np.asarray(age,dtype=np.float64)
+    pld = age/86400.
+    daily = (age>0)&(np.mod(age,86400.)==0)&(pld<=duration)
+    return({'particle':np.asarray(pindex,dtype=np.int32)[daily],
+            'pld':pld[daily].astype(np.int16),
+            'lon':np.asarray(lon,dtype=np.float32)[daily],
+            'lat':np.asarray(lat,dtype=np.float32)[daily]})
+
+#concatenate a list of endpoint columns
+def concat_endpoints(endpoints):
+    return({var:np.concatenate([x[var] for x in endpoints]) for var in ['particle','pld','lon','lat']})
+
+#write endpoint columns to outFile_endpoints.nc, sorted by pld and then particle index, with the release positions and
+#start position IDs of all particles (indexed by the particle column)
+def write_endpoints(outFile, endpoints, release_lon, release_lat, release_id=None):
+    order = np.lexsort((endpoints['particle'],endpoints['pld']))
+    ds = xr.Dataset(data_vars=dict(particle=(['obs'],endpoints['particle'][order]),
+                                   pld=(['obs'],endpoints['pld'][order]),
+                                   lon=(['obs'],endpoints['lon'][order]),
+                                   lat=(['obs'],endpoints['lat'][order]),
+                                   lon0=(['traj'],np.asarray(release_lon,dtype=np.float32)),
+                                   lat0=(['traj'],np.asarray(release_lat,dtype=np.float32)),
+                                   ID=(['traj'],get_ids(release_id,len(release_lon)))),
+                    attrs=dict(description='particle positions at integer-day ages (pld, days)'))
+    ds.to_netcdf(outFile+'_endpoints.nc')
+
+#combine zarr outputs from several release windows (shards) into a single store with the usual chunking
+#shards can have different time origins (each has its own fieldset) and different numbers of observations
+def combine_shards(shardFiles, outFile):
+    dsList = [xr.open_zarr(x,decode_times=False) for x in shardFiles]
+
+    #shift all times onto the earliest time origin
+    origins = [pd.Timestamp(ds['time'].attrs['units'].split('since')[1].strip()) for ds in dsList]
+    t0 = min(origins)
+    for ix in range(len(dsList)):
+        offset = (origins[ix]-t0).total_seconds()
+        tAttrs = dict(dsList[ix]['time'].attrs)
+        tAttrs['units'] = 'seconds since %s'%(t0)
+        dsList[ix]['time'] = dsList[ix]['time']+offset
+        dsList[ix]['time'].attrs = tAttrs
+
+    #stack along trajectory, padding shorter records with nans (as Parcels does)
+    combined = xr.concat(dsList,dim='trajectory',join='outer')
+    combined = combined.assign_coords(trajectory=np.arange(combined.sizes['trajectory'],dtype=np.int64)) #shards number particles from 0
+    if 'ID' in combined:
+        combined['ID'] = combined['ID'].fillna(-1).astype(np.int32) #(read back as float with nan fill)
+    combined = combined.chunk({'trajectory':2200,'obs':40})
+    for var in combined.variables:
+        combined[var].encoding = {}
+    outName = outFile if outFile.endswith('.zarr') else outFile+'.zarr'
+    combined.to_zarr(outName,mode='w')
+    for ds in dsList:
+        ds.close()
+
+#---numpy backend---
+#advects all particles at once with a vectorized RK4 on the depth-averaged C-grid fields; the interpolation follows Parcels'
+#NEMO C-grid scheme (cgrid_velocity) and the same age/out-of-bounds deletion, so it can be swapped in for run_particleset
+deg2m = 1852.*60. #meters per degree, as in Parcels
+
+#load grid and (lazily) the depth-averaged velocities for the numpy backend, along with a kd-tree of cell centres for the
+#initial cell lookup; indices restricts the grid as for make_fieldset
+def load_numpy_fields(uFiles, vFiles, indices=None):
+    glamf, gphif = load_fpoints()
+    uDs = xr.open_mfdataset(sorted(uFiles),combine='nested',concat_dim='time')
+    vDs = xr.open_mfdataset(sorted(vFiles),combine='nested',concat_dim='time')
+    uF = uDs['uAvg'][:,0,:,:]
+    vF = vDs['vAvg'][:,0,:,:]
+    if indices is not None:
+        ySl = slice(indices['lat'][0],indices['lat'][-1]+1)
+        xSl = slice(indices['lon'][0],indices['lon'][-1]+1)
+        glamf = glamf[ySl,xSl]
+        gphif = gphif[ySl,xSl]
+        uF = uF[:,ySl,xSl]
+        vF = vF[:,ySl,xSl]
+
+    #cell centres (mean of the four corners on the sphere) for the kd-tree
+    corners = [lonLatToXYZ(glamf[1:,:-1],gphif[1:,:-1]),lonLatToXYZ(glamf[1:,1:],gphif[1:,1:]),
+               lonLatToXYZ(glamf[:-1,:-1],gphif[:-1,:-1]),lonLatToXYZ(glamf[:-1,1:],gphif[:-1,1:])]
+    centres = (corners[0]+corners[1]+corners[2]+corners[3]).reshape(-1,3)
+    fields = {'glamf':glamf.astype(np.float64),
+              'gphif':gphif.astype(np.float64),
+              'latRange':(np.nanmin(gphif),np.nanmax(gphif)),
+              'U':uF,
+              'V':vF,
+              'times':uDs['time'].values,
+              'tree':cKDTree(centres),
+              'slices':{}}
+    return(fields)
+
+#get U and V at time index ti as arrays in memory (land/nan set to 0, as Parcels does); keeps the last few slices
+def get_slice(fields, ti):
+    cache = fields['slices']
+    if ti not in cache:
+        if len(cache)>=4: #particles only need two consecutive slices at a time
+            for key in sorted(cache)[:len(cache)-3]:
+                del cache[key]
+        uSl = np.nan_to_num(fields['U'][ti].values.astype(np.float64))
+        vSl = np.nan_to_num(fields['V'][ti].values.astype(np.float64))
+        cache[ti] = (uSl,vSl)
+    return(cache[ti])
+
+#lon/lat of the four corners of cells (yi, xi), counterclockwise from the lower left, with longitudes unwrapped around x
+def cell_corners(fields, xi, yi, x):
+    g = fields['glamf']
+    f = fields['gphif']
+    px = np.array([g[yi,xi],g[yi,xi+1],g[yi+1,xi+1],g[yi+1,xi]])
+    py = np.array([f[yi,xi],f[yi,xi+1],f[yi+1,xi+1],f[yi+1,xi]])
+    px[0] = np.where(px[0]<x-225.,px[0]+360.,px[0])
+    px[0] = np.where(px[0]>x+225.,px[0]-360.,px[0])
+    px[1:] = np.where(px[1:]-px[0]>180.,px[1:]-360.,px[1:])
+    px[1:] = np.where(-px[1:]+px[0]>180.,px[1:]+360.,px[1:])
+    return(px,py)
+
+#relative position (xsi, eta) of points x, y within cells with corners px, py (inverse bilinear map)
+def inverse_bilinear(px, py, x, y):
+    a0, a1, a2, a3 = px[0], px[1]-px[0], px[3]-px[0], px[0]-px[1]+px[2]-px[3]
+    b0, b1, b2, b3 = py[0], py[1]-py[0], py[3]-py[0], py[0]-py[1]+py[2]-py[3]
+    aa = a3*b2-a2*b3
+    bb = a3*b0-a0*b3+a1*b2-a2*b1+x*b3-y*a3
+    cc = a1*b0-a0*b1+x*b1-y*a1
+    with np.errstate(divide='ignore',invalid='ignore'):
+        det = np.sqrt(np.maximum(bb*bb-4.*aa*cc,0.))
+        eta = np.where(np.abs(aa)<1e-12,-cc/bb,(-bb+det)/(2.*aa))
+        den = a1+a3*eta
+        xsi = np.where(np.abs(den)<1e-12,((y-py[0])/(py[1]-py[0])+(y-py[3])/(py[2]-py[3]))*.5,(x-a0-a2*eta)/den)
+    return(xsi,eta)
+
+#find the cells containing points x, y, starting from cells (yi, xi) and walking one cell at a time towards the point;
+#points without a starting cell (xi<0) or that don't converge get a starting cell from the kd-tree of cell centres
+#returns cell indices, relative positions and a mask of points that are inside the grid
+def find_cells(fields, x, y, xi, yi, maxIter=20, tol=1e-10):
+    ny, nx = fields['glamf'].shape
+    xi = xi.copy()
+    yi = yi.copy()
+    xsi = np.zeros(len(x))
+    eta = np.zeros(len(x))
+    ok = np.zeros(len(x),dtype=bool)
+    inLat = (y>=fields['latRange'][0])&(y<=fields['latRange'][1])
+
+    for attempt in range(2):
+        guess = np.flatnonzero(inLat&~ok&((xi<0)|(attempt==1)))
+        if len(guess)>0: #cell centre lookup
+            _, cInd = fields['tree'].query(lonLatToXYZ(x[guess],y[guess]))
+            yi[guess], xi[guess] = np.unravel_index(cInd,(ny-1,nx-1))
+        todo = np.flatnonzero(inLat&~ok)
+        for it in range(maxIter):
+            if len(todo)==0:
+                break
+            px, py = cell_corners(fields,xi[todo],yi[todo],x[todo])
+            xs, et = inverse_bilinear(px,py,x[todo],y[todo])
+            inside = (xs>=-tol)&(xs<=1+tol)&(et>=-tol)&(et<=1+tol)
+            xsi[todo[inside]] = np.clip(xs[inside],0.,1.)
+            eta[todo[inside]] = np.clip(et[inside],0.,1.)
+            ok[todo[inside]] = True
+            #step towards the point
+            xi[todo] += np.where(xs<-tol,-1,np.where(xs>1+tol,1,0))*~inside
+            yi[todo] += np.where(et<-tol,-1,np.where(et>1+tol,1,0))*~inside
+            inGrid = (xi[todo]>=0)&(xi[todo]<nx-1)&(yi[todo]>=0)&(yi[todo]<ny-1)
+            xi[todo] = np.clip(xi[todo],0,nx-2)
+            yi[todo] = np.clip(yi[todo],0,ny-2)
+            todo = todo[~inside&inGrid]
+    return(xi,yi,xsi,eta,ok)
+
+#C-grid velocity (deg/s) at relative positions xsi, eta in cells (yi, xi) from one time slice of U and V (NEMO indexing)
+def cgrid_velocity(uSl, vSl, xi, yi, xsi, eta, px, py, y):
+    rad = np.pi/180.
+    #edge lengths, with the latitude taken along each edge at the particle position
+    def edge(i0, i1, lat):
+        return(np.sqrt(((px[i1]-px[i0])*deg2m*np.cos(rad*lat))**2+((py[i1]-py[i0])*deg2m)**2))
+    c1 = edge(0,1,(1-xsi)*py[0]+xsi*py[1])
+    c2 = edge(1,2,(1-eta)*py[1]+eta*py[2])
+    c3 = edge(2,3,(1-xsi)*py[3]+xsi*py[2])
+    c4 = edge(3,0,(1-eta)*py[0]+eta*py[3])
+    U0 = uSl[yi+1,xi]*c4
+    U1 = uSl[yi+1,xi+1]*c2
+    V0 = vSl[yi,xi+1]*c1
+    V1 = vSl[yi+1,xi+1]*c3
+    U = (1-xsi)*U0+xsi*U1
+    V = (1-eta)*V0+eta*V1
+
+    dphidxsi = np.array([eta-1.,1.-eta,eta,-eta])
+    dphideta = np.array([xsi-1.,-xsi,xsi,1.-xsi])
+    jac = (np.sum(px*dphidxsi,axis=0)*np.sum(py*dphideta,axis=0)-np.sum(px*dphideta,axis=0)*np.sum(py*dphidxsi,axis=0))
+    jac = jac*deg2m*deg2m*np.cos(rad*y)
+
+    w0 = -(1-eta)*U-(1-xsi)*V
+    w1 = (1-eta)*U-xsi*V
+    w2 = eta*U+xsi*V
+    w3 = -eta*U+(1-xsi)*V
+    u = (w0*px[0]+w1*px[1]+w2*px[2]+w3*px[3])/jac
+    v = (w0*py[0]+w1*py[1]+w2*py[2]+w3*py[3])/jac
+    return(u,v)
+
+#velocities (deg/s) at times t (seconds relative to tSec) and positions x, y, linearly interpolated in time
+#(held constant outside the field time range, like allow_time_extrapolation); also returns updated cells and in-grid mask
+def sample_velocity(fields, tSec, t, x, y, xi, yi):
+    xi, yi, xsi, eta, ok = find_cells(fields,x,y,xi,yi)
+    u = np.zeros(len(x))
+    v = np.zeros(len(x))
+    if len(tSec)>1:
+        ti = np.clip(np.searchsorted(tSec,t,side='right')-1,0,len(tSec)-2)
+        w = np.clip((t-tSec[ti])/(tSec[ti+1]-tSec[ti]),0.,1.)
+    else:
+        ti = np.zeros(len(x),dtype=int)
+        w = np.zeros(len(x))
+    for tix in np.unique(ti[ok]):
+        m = np.flatnonzero(ok&(ti==tix))
+        px, py = cell_corners(fields,xi[m],yi[m],x[m])
+        ua, va = cgrid_velocity(*get_slice(fields,tix),xi[m],yi[m],xsi[m],eta[m],px,py,y[m])
+        if len(tSec)>1:
+            ub, vb = cgrid_velocity(*get_slice(fields,tix+1),xi[m],yi[m],xsi[m],eta[m],px,py,y[m])
+        else:
+            ub, vb = ua, va
+        u[m] = ua+(ub-ua)*w[m]
+        v[m] = va+(vb-va)*w[m]
+    return(u,v,xi,yi,ok)
+
+#one RK4 step of length h (per particle) from times t, same stages as Parcels' AdvectionRK4; also returns the cells of the
+#new positions and a mask of particles that stayed in the grid
+def rk4_step(fields, tSec, t, h, x, y, xi, yi):
+    u1, v1, xi, yi, ok1 = sample_velocity(fields,tSec,t,x,y,xi,yi)
+    u2, v2, xi, yi, ok2 = sample_velocity(fields,tSec,t+.5*h,x+u1*.5*h,y+v1*.5*h,xi,yi)
+    u3, v3, xi, yi, ok3 = sample_velocity(fields,tSec,t+.5*h,x+u2*.5*h,y+v2*.5*h,xi,yi)
+    u4, v4, xi, yi, ok4 = sample_velocity(fields,tSec,t+h,x+u3*h,y+v3*h,xi,yi)
+    xN = x+(u1+2.*u2+2.*u3+u4)/6.*h
+    yN = y+(v1+2.*v2+2.*v3+v4)/6.*h
+    xi, yi, _, _, ok5 = find_cells(fields,xN,yN,xi,yi) #a step that ends outside the grid is out of bounds too
+    return(xN,yN,xi,yi,ok1&ok2&ok3&ok4&ok5)
+
+#write trajectories in the same layout as Parcels' zarr output (trajectory x obs, nan padded, time in seconds, ID once per trajectory)
+def write_trajectories(outFile, lonOut, latOut, timeOut, ageOut, t0, ID):
+    nObs = max(np.amax(np.sum(~np.isnan(timeOut),axis=1)),1) if len(timeOut)>0 else 1
+    ds = xr.Dataset(data_vars=dict(lon=(['trajectory','obs'],lonOut[:,:nObs]),
+                                   lat=(['trajectory','obs'],latOut[:,:nObs]),
+                                   time=(['trajectory','obs'],timeOut[:,:nObs]),
+                                   age=(['trajectory','obs'],ageOut[:,:nObs]),
+                                   ID=(['trajectory'],ID)),
+                    coords=dict(trajectory=np.arange(len(timeOut),dtype=np.int64),
+                                obs=np.arange(nObs,dtype=np.int32)))
+    ds['time'].attrs = {'long_name':'','standard_name':'time','units':'seconds since %s'%(pd.Timestamp(t0)),'calendar':'standard','axis':'T'}
+    ds = ds.chunk({'trajectory':2200,'obs':40})
+    outName = outFile if outFile.endswith('.zarr') else outFile+'.zarr'
+    ds.to_zarr(outName,mode='w')
+
+#track one set of particles with the numpy backend; same arguments as run_particleset, with fields from load_numpy_fields
+#returns (number of particle steps taken (for throughput), endpoint columns) - the endpoint columns are None unless
+#output_mode='endpoints'
+def run_numpy(fields, release_lon, release_lat, time_release, duration, output_frequency, outFile, output_mode='trajectory', release_id=None, dt=3600.):
+    t0 = np.amin(time_release)
+    rel = (time_release-t0)/np.timedelta64(1,'s') #release times in seconds from first release
+    tSec = (fields['times']-t0)/np.timedelta64(1,'s') #field times in seconds from first release
+    maxage = pd.Timedelta(days=duration).total_seconds()
+    outDt = output_frequency*3600.
+    tEnd = np.amax(rel)+maxage
+
+    nPart = len(rel)
+    trajectories = output_mode=='trajectory'
+    if trajectories:
+        maxObs = int(np.ceil(maxage/outDt))+3 #outputs, plus a partial first interval and the write on deletion
+        lonOut = np.full((nPart,maxObs),np.nan,dtype=np.float32)
+        latOut = np.full((nPart,maxObs),np.nan,dtype=np.float32)
+        timeOut = np.full((nPart,maxObs),np.nan)
+        ageOut = np.full((nPart,maxObs),np.nan,dtype=np.float32)
+        nObs = np.zeros(nPart,dtype=int)
+    endpoints = []
+
+    x = np.array(release_lon,dtype=np.float64)
+    y = np.array(release_lat,dtype=np.float64)
+    pt = rel.copy() #particle times
+    age = np.zeros(nPart)
+    xi = np.full(nPart,-1,dtype=int)
+    yi = np.full(nPart,-1,dtype=int)
+    released = np.zeros(nPart,dtype=bool)
+    alive = np.zeros(nPart,dtype=bool)
+    nSteps = 0
+
+    #record the current state of particles w (Parcels also writes particles once more when they are deleted)
+    def record(w):
+        if not trajectories:
+            return
+        lonOut[w,nObs[w]] = x[w]
+        latOut[w,nObs[w]] = y[w]
+        timeOut[w,nObs[w]] = pt[w]
+        ageOut[w,nObs[w]] = age[w]
+        nObs[w] += 1
+
+    t = 0.
+    while True:
+        #release particles that start before the next step
+        new = np.flatnonzero(~released&((rel<=t)|(rel<min(t+dt,tEnd))))
+        if len(new)>0:
+            released[new] = True
+            xi[new], yi[new], _, _, ok = find_cells(fields,x[new],y[new],xi[new],yi[new])
+            alive[new] = ok
+            if np.any(~ok):
+                print('deleting %s particles released out of bounds'%(np.sum(~ok)))
+
+        #write particles that are at an output time
+        if abs(t/outDt-np.round(t/outDt))<1e-9:
+            record(np.flatnonzero(alive&(pt==t)))
+        if t>=tEnd:
+            break
+
+        #advance all active particles to the next step
+        T = min(t+dt,tEnd)
+        act = np.flatnonzero(alive&(pt<T))
+        if len(act)>0:
+            h = T-pt[act]
+            xN, yN, xiN, yiN, ok = rk4_step(fields,tSec,pt[act],h,x[act],y[act],xi[act],yi[act])
+            #out of bounds particles are deleted where they were
+            record(act[~ok])
+            alive[act[~ok]] = False
+            act = act[ok]
+            x[act], y[act], xi[act], yi[act] = xN[ok], yN[ok], xiN[ok], yiN[ok]
+            pt[act] = T
+            age[act] += h[ok]
+            if not trajectories:
+                endpoints.append(sample_endpoints(act,age[act],x[act],y[act],duration))
+            #delete particles older than maxage
+            old = act[age[act]>maxage]
+            record(old)
+            alive[old] = False
+            nSteps += len(h)
+        t = T
+
+    if not trajectories:
+        return(nSteps,concat_endpoints(endpoints))
+    write_trajectories(outFile,lonOut,latOut,timeOut,ageOut,t0,get_ids(release_id,nPart))
+    return(nSteps,None)
+
+#index window for a set of releases - domain is None (global grid), 'auto' (releases plus travel margin),
+#a (lonMin, lonMax, latMin, latMax) box, or an index window {'lon': range, 'lat': range}
+def get_indices(domain, release_lon, release_lat, duration):
+    if domain is None or isinstance(domain,dict):
+        return(domain)
+    if isinstance(domain,str) and domain=='auto':
+        return(domain_indices(release_lon,release_lat,duration))
+    return(domain_indices(release_lon,release_lat,duration,bbox=domain))
+
+#load fields for the chosen backend and track one set of particles (uFiles/vFiles of None means every year)
+#returns the endpoint columns with output_mode='endpoints'
+def run_backend(backend, uFiles, vFiles, indices, release_lon, release_lat, time_release, duration, output_frequency, outFile, output_mode, release_id=None):
+    print('making fieldset')
+    if backend=='parcels':
+        fSet = make_fieldset(uFiles,vFiles,indices)
+        print('done with fieldset')
+        return(run_particleset(fSet,release_lon,release_lat,time_release,duration,output_frequency,outFile,output_mode,release_id))
+    elif backend=='numpy':
+        if uFiles is None:
+            uFiles = glob.glob(fnameU)
+            vFiles = glob.glob(fnameV)
+        fields = load_numpy_fields(uFiles,vFiles,indices)
+        print('done with fieldset')
+        t1 = time.time()
+        nSteps, endpoints = run_numpy(fields,release_lon,release_lat,time_release,duration,output_frequency,outFile,output_mode,release_id)
+        print('numpy backend: %s particle steps in %0.1fs (%0.3g particles*steps/s)'%(nSteps,time.time()-t1,nSteps/max(time.time()-t1,1e-9)))
+        return(endpoints)
+    else:
+        raise ValueError('unknown backend %s'%(backend))
+
+#core function to track particles using Parcels
+#shard_days splits the releases into windows of shard_days days, each tracked with its own particleset and a fieldset that
+#only covers that window (+duration), and the shards are combined into outFile at the end
+#domain restricts the grid that is read (see get_indices); with shards, an 'auto' domain is computed for each shard
+#particles that leave the domain are deleted, as they are at the edge of the global grid
+#backend is 'parcels' (JIT kernels) or 'numpy' (vectorized RK4, see run_numpy)
+#output_mode is 'trajectory' (full trajectories every output_frequency hours in outFile.zarr) or 'endpoints' (only positions at
+#integer-day ages, in outFile_endpoints.nc - see write_endpoints)
+#release_id (optional) is an integer start position ID for each release, stored once per trajectory as ID
+def track_particles(release_lon, release_lat, release_time, duration, output_frequency, outFile, shard_days=None, domain=None, backend='parcels', output_mode='trajectory', release_id=None):
+    t1 = time.time() #start time, for reporting execution time
+    #get release times in proper datetime64 format
+    time_release = np.array([np.datetime64(x)for x in release_time])
+    release_lon = np.array(release_lon)
+    release_lat = np.array(release_lat)
+    release_id = get_ids(release_id,len(release_lon))
+
+    #get first release in startlist
+    firstRelease = np.amin(time_release)
+    print(firstRelease) #print the first release
+
+    if shard_days is None:
+        endpoints = run_backend(backend,None,None,get_indices(domain,release_lon,release_lat,duration),release_lon,release_lat,
+                                time_release,duration,output_frequency,outFile,output_mode,release_id)
+        if output_mode=='endpoints':
+            write_endpoints(outFile,endpoints,release_lon,release_lat,release_id)
+    else:
+        #assign each release to a window, counting from the first release
+        tSec = (time_release-firstRelease)/np.timedelta64(1,'s')
+        window = (tSec//pd.Timedelta(days=shard_days).total_seconds()).astype(int)
+        shardDir = outFile+'_shards/'
+        os.makedirs(shardDir,exist_ok=True)
+        shardFiles = []
+        endpoints = []
+        for wn in np.unique(window):
+            wMask = window==wn
+            wTime = time_release[wMask]
+            tStart = np.amin(wTime)
+            tEnd = np.amax(wTime)+np.timedelta64(int(duration*86400),'s')
+            print('shard %s: %s particles released %s to %s'%(wn,np.sum(wMask),tStart,np.amax(wTime)))
+            uFiles, vFiles = window_files(tStart,tEnd)
+            shardName = shardDir+'shard%03d.zarr'%(wn)
+            shardEnds = run_backend(backend,uFiles,vFiles,get_indices(domain,release_lon[wMask],release_lat[wMask],duration),
+                                    release_lon[wMask],release_lat[wMask],wTime,duration,output_frequency,shardName,output_mode,
+                                    release_id[wMask])
+            if output_mode=='endpoints':
+                shardEnds['particle'] = np.flatnonzero(wMask)[shardEnds['particle']].astype(np.int32) #shard to global index
+                endpoints.append(shardEnds)
+            else:
+                shardFiles.append(shardName)
+        if output_mode=='endpoints':
+            write_endpoints(outFile,concat_endpoints(endpoints),release_lon,release_lat,release_id)
+        else:
+            print('combining %s shards'%(len(shardFiles)))
+            combine_shards(shardFiles,outFile)
+        shutil.rmtree(shardDir)
+
+    print('done with execution in %ss'%(time.time()-t1))
+
 if __name__=='__main__':
     #some sample test cases...
     if False:
@@ -113,3 +625,78 @@ if __name__=='__main__':
         out_freq = 12.0
 
         track_particles(sLon,sLat,rel_dates,15.0, out_freq, of_name)
+
+    #benchmark of sharded (monthly release windows) against a single particleset for one year of releases
+    if False:
+        num_samples = 1460
+        sLon = np.full(num_samples,-68.0)
+        sLat = np.full(num_samples,43.0)
+        rel_dates = pd.date_range(start='1/1/2010',periods=num_samples,freq='6h')
+        out_freq = 6.0
+
+        tBench = time.time()
+        track_particles(sLon,sLat,rel_dates,60.0, out_freq, 'pTracking_bench_single')
+        tSingle = time.time()-tBench
+        tBench = time.time()
+        track_particles(sLon,sLat,rel_dates,60.0, out_freq, 'pTracking_bench_sharded',shard_days=30)
+        tSharded = time.time()-tBench
+        print('single particleset: %0.1fs, monthly shards: %0.1fs (speedup %0.2fx)'%(tSingle,tSharded,tSingle/tSharded))
+
+    #numpy backend against Parcels on a small synthetic curvilinear grid with a time-varying eddy, and throughput of both
+    #positions typically agree to ~1e-5 degrees; a few particles differ by ~1e-4 degrees where they cross a cell face at a
+    #slightly different time (the C-grid velocity is discontinuous across faces and Parcels' JIT uses float32 velocities)
+    if False:
+        testDir = './numpy_backend_test/'
+        os.makedirs(testDir,exist_ok=True)
+        ny, nx = 60, 80
+        jj, ii = np.mgrid[0:ny,0:nx].astype(float)
+        glamf = -72.+0.1*ii+0.02*jj #skewed grid
+        gphif = 38.+0.08*jj-0.01*ii
+        gridFile = testDir+'test_mesh_hgr.nc'
+        xr.Dataset({'glamf':(('t','y','x'),glamf[None]),'gphif':(('t','y','x'),gphif[None])}).to_netcdf(gridFile)
+        filenames['U']['lon'] = filenames['U']['lat'] = filenames['V']['lon'] = filenames['V']['lat'] = gridFile
+        dates = pd.date_range('1/1/2010 12:00',periods=20)
+        amp = np.linspace(0.3,0.1,len(dates))[:,None,None,None]
+        uTest = (-amp*(gphif-41.)/2.+0.05).astype(np.float32)
+        vTest = (amp*(glamf+68.)/2.*np.cos(np.radians(41.))*np.ones(uTest.shape)).astype(np.float32)
+        uName = testDir+'test_u.nc'
+        vName = testDir+'test_v.nc'
+        xr.Dataset({'uAvg':(('time','depth','y','x'),uTest)},coords={'time':dates,'depth':[15.]}).to_netcdf(uName)
+        xr.Dataset({'vAvg':(('time','depth','y','x'),vTest)},coords={'time':dates,'depth':[15.]}).to_netcdf(vName)
+
+        num_samples = 5000
+        sLon = np.random.uniform(-70.,-66.,num_samples)
+        sLat = np.random.uniform(40.,42.,num_samples)
+        rel_dates = np.array(pd.Timestamp('1/2/2010')+pd.to_timedelta(np.random.randint(0,8,num_samples)*6,unit='h'),dtype='datetime64[ns]')
+        testDuration = 5.
+
+        tBench = time.time()
+        run_particleset(make_fieldset([uName],[vName]),sLon,sLat,rel_dates,testDuration,6.,testDir+'parcels_out')
+        tParcels = time.time()-tBench
+        tBench = time.time()
+        nSteps, _ = run_numpy(load_numpy_fields([uName],[vName]),sLon,sLat,rel_dates,testDuration,6.,testDir+'numpy_out')
+        tNumpy = time.time()-tBench
+        print('parcels: %0.3g particles*steps/s, numpy: %0.3g particles*steps/s'%(nSteps/tParcels,nSteps/tNumpy))
+
+        #Parcels writes trajectories in the order particles are written, so reorder by trajectory id
+        pOut = xr.open_zarr(testDir+'parcels_out.zarr',decode_times=False)
+        nOut = xr.open_zarr(testDir+'numpy_out.zarr',decode_times=False)
+        tid = pOut['trajectory'].values
+        pOrd = np.argsort(np.where(tid<0,np.iinfo(np.int64).max,tid))[:num_samples]
+        nCol = min(pOut.sizes['obs'],nOut.sizes['obs'])
+        pLon = pOut['lon'].values[pOrd,:nCol]
+        nLon = nOut['lon'].values[:,:nCol]
+        pLat = pOut['lat'].values[pOrd,:nCol]
+        nLat = nOut['lat'].values[:,:nCol]
+        pAge = pOut['age'].values[pOrd,:nCol]
+        nAge = nOut['age'].values[:,:nCol]
+        same = np.all(np.isnan(pLon)==np.isnan(nLon),axis=1)
+        dPos = np.nanmax(np.hypot(pLon-nLon,pLat-nLat)[same],axis=1)
+        print('%s of %s particles deleted at the same time'%(np.sum(same),num_samples))
+        print('position difference (deg): median %0.2g, 99th percentile %0.2g, max %0.2g'%(np.median(dPos),np.percentile(dPos,99),np.amax(dPos)))
+        assert np.sum(same)>=0.99*num_samples, 'deletions do not match'
+        nDiff = np.abs(np.sum(~np.isnan(pLon),axis=1)-np.sum(~np.isnan(nLon),axis=1))
+        assert np.all(nDiff<=1), 'particles deleted more than one output apart'
+        ageSame = np.all(np.isclose(pAge,nAge)|(np.isnan(pAge)&np.isnan(nAge)),axis=1) #(the write on deletion can differ by a step)
+        assert np.sum(ageSame)>=0.99*num_samples, 'ages do not match'
+        assert np.median(dPos)<1e-4 and np.percentile(dPos,99)<1e-3 and np.amax(dPos)<1e-2, 'positions do not match'
@@ -3,47 +3,26 @@ import numpy as np
 import pylab as p
 import netCDF4 as nc
 import scipy.stats as sps
-from loadData import loadGrid, loadData
+from loadData import loadGrid, loadData, loadDistances
+from groupByID import segmentRepeat
 from sklearn.neighbors import KernelDensity 
 import cartopy.crs as ccrs
 import cartopy.feature as ftr
 import seawater.extras as swe
 from tqdm import tqdm
 
-dDir = None #directory where dispersal vectors are stored
-
-#load precomputed location dicts:
-dDict = np.load('drifterDistances_6_24_24.npz',allow_pickle=True)
-numerical = dDict['numerical'].item()
-drifters = dDict['drifters'].item()
-centroids = dDict['centroids'].item()
+dDir = None #directory where dispersal vectors are stored (store location is distName in loadData.py)
 
 for pld in [30]: #code can be run for other drifter durations (1 to 60 days), currently just doing 30-day duration
-    idArr, lonArr, latArr = loadData(pld) #load ids for numerical drifters
-
-    dArr = [] #dArr is for GDP drifters (d for drifter)
-    cArr = [] #cArr is for numerical centroids (c for centroid)
-    mArr = [] #mArr is for numerical drifters (m for model)
-    pArr = [] #pArr is for normalized GDP drifters (pArr for plot, because this is the quantity I was originally plotting with this code)
-
-    #iterate over all ids:
-    for trID in np.unique(idArr):
-        key = (pld,trID) #key in distance dict
-        if (key in drifters.keys()) and (key in centroids.keys()):
-            dri = drifters[key][0] #get GDP drifter disp. vector
-            cen = centroids[key][0] #get centroid disp. vector
-            num = numerical[key][0] #get numerical disp. vectors
-            if cen==0: #ignore non-moving numerical drifters 
-                continue
-            
-            dArr.append(dri) #append GDP drifter disp. vector to dArr
-            cArr.append(cen) #append centroid disp vector to cArr
-            mArr.append(num/cen) #normalize numerical drifter dispersal vectors and append to mArr (normalization must happen in each loop for numerical drifters due to array size; probably a better way to handle)
-
-    #make lists into arrays
-    dArr = np.ravel(dArr)
-    cArr = np.ravel(cArr)
-    mArr = np.ravel(mArr)
+    dist = loadDistances(pld) #load precomputed dispersal vectors for this drifter duration only (memory mapped)
+    dri = dist['drifters'].astype(complex) #GDP drifter disp. vectors (d for drifter)
+    cen = dist['centroids'].astype(complex) #centroid disp. vectors (c for centroid)
+    num = dist['numerical'].astype(complex) #numerical disp. vectors for all IDs (m for model), grouped by numOffsets
+
+    moving = cen!=0 #ignore non-moving numerical drifters
+    dArr = dri[moving]
+    cArr = cen[moving]
+    mArr = (num/segmentRepeat(cen,dist['numOffsets']))[segmentRepeat(moving,dist['numOffsets'])] #normalize numerical drifter dispersal vectors by the centroid for their ID
 
     #check that the length of GDP and centroid array match
     assert len(cArr)==len(dArr), 'lengths do not match'
@@ -1,118 +1,89 @@
 #code for plotting median normalized dispersal distance (figure 5 in text) and ratio in stochastic dispersal component (figure 6 in text)
 import numpy as np
+import os
 import pylab as p
 import netCDF4 as nc
 import scipy.stats as sps
-from loadData import loadGrid, loadData #uses loadData.py
+from loadData import loadGrid, loadData, distName, distStoreVars #uses loadData.py
+from dispersalStats import allPldStats, bootstrapAll
+from precomputeDistance import hashFiles #hash of file contents (uses precomputeDistance.py)
 from sklearn.neighbors import KernelDensity 
 import cartopy.crs as ccrs
 import cartopy.feature as ftr
 import seawater.extras as swe
 from tqdm import tqdm
 
-dDir = None #directory where dispersal vectors are stored
-
-#load precomputed dispersal vectors:
-dDict = np.load('drifterDistances_6_24_24.npz',allow_pickle=True) 
-numerical = dDict['numerical'].item() #load numerical dispersal vectors
-drifters = dDict['drifters'].item() #load GDP dispersal vectors
-centroids = dDict['centroids'].item() #load centroid dispersal vector
+dDir = None #directory where dispersal vectors are stored (store location is distName in loadData.py)
 
+useSketch = False #numerical iqrs from bounded-memory quantile sketches (quartiles within 0.5% of the values either side) instead of exact quantiles
+useBootstrap = False #plot bootstrap confidence bands (resampling start IDs)
+nRep = 1000 #number of bootstrap replicates
+bootSeed = 0 #seed for bootstrap replicates
+ci = (2.5,97.5) #percentiles for confidence bands
+bandsName = None #file where bootstrap bands are cached (.npz, loaded if it was saved with the same settings and dispersal vectors)
 pldArr = np.arange(1,61) #make array of drifter durations (again, PLD stands for pelagic larval duration, since we're thinking about larvae)
 
-#lists to plot median normalized GDP dispersal
-median_r = []
-median_i = []
-
-#lists to save ratios of iqrs (norm. GDP/norm. numerical)
-iqr_ratio = []
-iqr_ratio_i = []
-
-#iterate over all drifter durations with progress bar
-for pld in tqdm(pldArr):
-    idArr, lonArr, latArr = loadData(pld) #load ids for numerical drifters
-
-    dArr = [] #dArr is for GDP drifters (d for drifter)
-    cArr = [] #cArr is for numerical centroids (c for centroid)
-    mArr = [] #mArr is for numerical drifters (m for model)
-    pArr = [] #pArr is for normalized GDP drifters (pArr for plot, because this is the quantity I was originally plotting with this code)
-    #iterate over all ids:
-    for trID in np.unique(idArr):
-        key = (pld,trID) #key in distance dict
-        if key in drifters.keys():
-            dri = drifters[key][0].flatten() #get GDP drifter disp. vector & flatten
-            cen = centroids[key][0].flatten() #get centroid disp. vector
-            if cen==0: #ignore non-moving numerical drifters 
-                continue
-            num = numerical[key][0].flatten() #get numerical disp. vectors
-            nMsk = ~np.isnan(num) #ignore nans in numerical disp vectors
-            num = num[nMsk]
-            if np.any(np.isnan(num/cen)): #catch any nans in normalization
-                assert False #(this will throw an assertion error)
-
-            dArr.append(dri.item()) #append GDP drifter disp. vector to dArr
-            cArr.append(cen.item()) #append centroid disp vector to cArr
-            mArr.extend(num/cen) #normalize numerical drifter dispersal vectors and append to mArr (normalization must happen in each loop for numerical drifters due to array size; probably a better way to handle)
-
-    #make lists into arrays
-    dArr = np.array(dArr)
-    cArr = np.array(cArr)
-    mArr = np.array(mArr)
-
-    #check that the length of GDP and centroid array match
-    assert len(cArr)==len(dArr), 'lengths do not match'
-    
-    pArr = dArr/cArr #normalize GDP drifter disp. vectors by centroid vector
-    
-    nMask = ~np.isnan(pArr) #mask to remove nans 
-    pArr = pArr[nMask]
-
-    iMask = ~np.isinf(pArr) #mask to remove infinite values
-    pArr = pArr[iMask]
-
-    realVal = np.real(pArr) #real component of pArr
-    imagVal = np.imag(pArr) #imaginary component of pArr
-    
-    median_r.append(np.median(realVal)) #compute the median value of the real component and append to list for plotting
-    median_i.append(np.median(imagVal)) #compute the median value of the imag. component and append to list for plotting
-    rv = sps.iqr(realVal) #compute iqr of real component of normalized GDP drifters
-    iv = sps.iqr(imagVal) #compute iqr of imag. component of normalized GDP drifters
-
-    mStd_r = sps.iqr(np.real(mArr)) #compute iqr of real component of normalized numerical drifters
-    mStd_i = sps.iqr(np.imag(mArr)) #compute iqr of imag. component of normalized numerical drifters
-    
-    rt = rv/mStd_r #compute ratio of GDP iqr over numerical iqr (real component)
-    rti = iv/mStd_i #compute ratio of GDP iqr over numerical iqr (imag. component)
-    iqr_ratio.append(rt) #append to list for plotting
-    iqr_ratio_i.append(rti)
-
-saveDir = None # directory to save figure
-
-#plotting code for figure 5 (median normalized GDP dispersal) 
-if True:
-    p.style.use('ggplot')
-    p.figure(figsize=(6,4))
-    p.clf()
-    p.title('Median  ' + r"$\vec {R_{d}^{obs}}}$",fontsize='x-large')
-    p.plot(pldArr,median_r,label = 'real')
-    p.plot(pldArr,median_i,label = 'imag')
-    p.xlabel('drifter duration (days)',fontsize='large')
-    p.ylabel(r"$\vec {R_{d}^{obs}}}$       ",rotation='horizontal',fontsize='large')
-    p.legend(fontsize='large')
-    p.tight_layout()
-    p.show()
-    p.savefig(saveDir+'medianVals.png')
-
-#plotting code for figure 6 (ratio of iqrs of norm. GDP over norm. numerical dispersal)
-if True:
-    p.figure(figsize=(6,4))
-    p.clf()
-    p.title('Ratio of '+r"$L_{diff}^{obs}$"+' to '+r"$L_{diff}^{m}$",fontsize='x-large')
-    p.plot(pldArr,std_ratio,label='real')
-    p.plot(pldArr,std_ratio_i,label='imaginary')
-    p.xlabel('drifter duration (days)',fontsize='large')
-    p.ylabel(r"$\frac{L_{diff}^{obs}}{L_{diff}^{m}}$     ",rotation='horizontal',fontsize='xx-large')
-    p.legend(fontsize='large')
-    p.tight_layout()
-    p.show()
-    p.savefig(saveDir+'lDiff_ratios.png')
+#bootstrap bands for every curve, loaded from bandsName if they were cached with the same settings from the same dispersal
+#vector store (by content hash, so bands are redone after precomputeDistance.py rewrites it), otherwise computed (in worker
+#processes, see bootstrapAll in dispersalStats.py) and cached
+def bootstrapBands():
+    settings = {'pldArr':pldArr,'nRep':nRep,'bootSeed':bootSeed,'ci':np.array(ci),
+                'storeHash':np.array(hashFiles([distName+var+'.npy' for var in distStoreVars]))}
+    if bandsName is not None and os.path.exists(bandsName):
+        saved = np.load(bandsName)
+        if all(var in saved.files and np.array_equal(saved[var],settings[var]) for var in settings):
+            return({var[5:]:saved[var] for var in saved.files if var.startswith('band_')})
+    bands = bootstrapAll(pldArr,nRep=nRep,seed=bootSeed,ci=ci)
+    if bandsName is not None:
+        np.savez(bandsName,**settings,**{'band_'+var:bands[var] for var in bands})
+    return(bands)
+
+#everything below runs only in the main process, since bootstrap worker processes import this file
+if __name__=='__main__':
+    #median normalized GDP dispersal and ratios of iqrs (norm. GDP/norm. numerical) for all drifter durations
+    stats = allPldStats(pldArr,sketch=useSketch)
+    median_r = stats['median_r']
+    median_i = stats['median_i']
+    iqr_ratio = stats['iqr_ratio']
+    iqr_ratio_i = stats['iqr_ratio_i']
+
+    #confidence bands (len(pldArr) x 2, lower and upper) for each curve
+    if useBootstrap:
+        bands = bootstrapBands()
+
+    saveDir = None # directory to save figure
+
+    #plotting code for figure 5 (median normalized GDP dispersal) 
+    if True:
+        p.style.use('ggplot')
+        p.figure(figsize=(6,4))
+        p.clf()
+        p.title('Median  ' + r"$\vec {R_{d}^{obs}}}$",fontsize='x-large')
+        p.plot(pldArr,median_r,label = 'real')
+        p.plot(pldArr,median_i,label = 'imag')
+        if useBootstrap:
+            p.fill_between(pldArr,bands['median_r'][:,0],bands['median_r'][:,1],color='C0',alpha=0.3,lw=0)
+            p.fill_between(pldArr,bands['median_i'][:,0],bands['median_i'][:,1],color='C1',alpha=0.3,lw=0)
+        p.xlabel('drifter duration (days)',fontsize='large')
+        p.ylabel(r"$\vec {R_{d}^{obs}}}$       ",rotation='horizontal',fontsize='large')
+        p.legend(fontsize='large')
+        p.tight_layout()
+        p.show()
+        p.savefig(saveDir+'medianVals.png')
+
+    #plotting code for figure 6 (ratio of iqrs of norm. GDP over norm. numerical dispersal)
+    if True:
+        p.figure(figsize=(6,4))
+        p.clf()
+        p.title('Ratio of '+r"$L_{diff}^{obs}$"+' to '+r"$L_{diff}^{m}$",fontsize='x-large')
+        p.plot(pldArr,iqr_ratio,label='real')
+        p.plot(pldArr,iqr_ratio_i,label='imaginary')
+        if useBootstrap:
+            p.fill_between(pldArr,bands['iqr_ratio'][:,0],bands['iqr_ratio'][:,1],color='C0',alpha=0.3,lw=0)
+            p.fill_between(pldArr,bands['iqr_ratio_i'][:,0],bands['iqr_ratio_i'][:,1],color='C1',alpha=0.3,lw=0)
+        p.xlabel('drifter duration (days)',fontsize='large')
+        p.ylabel(r"$\frac{L_{diff}^{obs}}{L_{diff}^{m}}$     ",rotation='horizontal',fontsize='xx-large')
+        p.legend(fontsize='large')
+        p.tight_layout()
+        p.show()
+        p.savefig(saveDir+'lDiff_ratios.png')
@@ -1,102 +1,166 @@
 #Code to get drifter dispersal vectors for both numerical and GDP drifter trajectories and save as complex numbers
+#each drifter duration is computed in its own process and cached as a shard keyed on a hash of its inputs, then shards are merged
 import numpy as np
 import pylab as p
 import netCDF4 as nc
-from loadData import loadGrid, loadData
-import seawater.extras as swe
-from tqdm import tqdm
-
-def getCentroid(lon,lat): #calculating centroid location on sphere
-    lon = np.radians(lon)
-    lat = np.radians(lat)
-    
-    x1 = np.cos(lat)*np.cos(lon)
-    y1 = np.cos(lat)*np.sin(lon)
-    z1 = np.sin(lat)
-
-    xa = np.mean(x1)
-    ya = np.mean(y1)
-    za = np.mean(z1)
-
-    cLon = np.arctan2(ya,xa)
-    hyp = np.sqrt((xa**2) + (ya**2))
-    cLat = np.arctan2(za,hyp)
-    return(np.degrees(cLon),np.degrees(cLat))
+import os
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from loadData import loadStarts, loadData, trajName, startName, saveDistances, loadTrajectories, trajStoreVars
+from groupByID import segmentOffsets, segmentCentroid, segmentRepeat, sortByID
+
+#dispersal vectors from start (stLon, stLat) to end (endLon, endLat) positions as complex numbers, for whole arrays at once
+#same plane-sailing distance (km) and angle as swe.dist([stLat,endLat],[stLon,endLon]) - real part is len*sin(angle) and
+#imaginary part is len*cos(angle), as in the per-particle calls this replaces
+def dispersalVectors(stLon, stLat, endLon, endLat):
+    stLon, stLat, endLon, endLat = np.broadcast_arrays(*[np.asarray(x,dtype=np.float64) for x in [stLon,stLat,endLon,endLat]])
+    dLon = endLon-stLon
+    wrap = np.abs(dLon)>180. #go the short way around the globe
+    dLon = np.where(wrap,-np.sign(dLon)*(360.-np.abs(dLon)),dLon)
+    dep = np.cos((np.abs(np.radians(stLat))+np.abs(np.radians(endLat)))/2.)*dLon #zonal departure (degrees of latitude)
+    dLat = endLat-stLat
+    #distance is 60*1.852*sqrt(dLat**2+dep**2) km at angle arctan2(dLat,dep), so len*sin(angle) and len*cos(angle) are:
+    return(60.*1.852*dLat+1j*60.*1.852*dep)
+
+#check dispersalVectors against swe.dist on random start/end pairs (including across the dateline) and time both
+if False:
+    import seawater.extras as swe
+    import time
+    nTest = 20000
+    tStLon = np.random.uniform(-180.,180.,nTest)
+    tStLat = np.random.uniform(-80.,80.,nTest)
+    tEndLon = tStLon+np.random.uniform(-5.,5.,nTest)
+    tEndLon = np.where(tEndLon>180.,tEndLon-360.,tEndLon)
+    tEndLat = tStLat+np.random.uniform(-5.,5.,nTest)
+
+    t1 = time.time()
+    sLen,sAng = np.array(list(zip(*[swe.dist([tStLat[x],tEndLat[x]],[tStLon[x],tEndLon[x]]) for x in np.arange(nTest)])))
+    sVec = (sLen*np.sin(np.radians(sAng))+1j*sLen*np.cos(np.radians(sAng))).flatten()
+    tSwe = time.time()-t1
+    t1 = time.time()
+    vVec = dispersalVectors(tStLon,tStLat,tEndLon,tEndLat)
+    tVec = time.time()-t1
+    print('max difference from swe.dist: %0.2g km'%(np.amax(np.abs(sVec-vVec))))
+    print('swe.dist: %0.3fs, dispersalVectors: %0.4fs for %s pairs'%(tSwe,tVec,nTest))
+    assert np.allclose(sVec,vVec,rtol=0.,atol=1e-9), 'dispersal vectors do not match swe.dist'
+
+#index of the GDP observation at each integer-day age, built once from the ages of the simplified GDP trajectories (segment
+#k is age[offsets[k]:offsets[k+1]]) - returns an (n_segments x nDays) array of rows into the trajectory columns, where column
+#pld-1 is the row at an age of pld days (-1 if there is no observation at that age)
+def buildAgeIndex(age, offsets, nDays=60):
+    drRow = segmentRepeat(np.arange(len(offsets)-1),offsets) #segment for each observation
+
+    day = np.asarray(age)/(24*3600)
+    daily = (day==np.round(day))&(day>=1)&(day<=nDays) #observations at integer-day ages (time is in sec)
+    obs = np.flatnonzero(daily)[::-1] #(reversed, so the first observation at an age wins if there are several)
+    ageIndex = np.full((len(offsets)-1,nDays),-1,dtype=np.int64)
+    ageIndex[drRow[obs],day[obs].astype(int)-1] = obs
+    return(ageIndex)
 
 dDir = './' #directory where simplified GDP trajectory data is stored
-
-#load GDP drifter data
-trajDict = np.load(dDir+'trajDict_04_04_24.npz',allow_pickle=True) #load simplified GDP drifter trajectory
-dDict = trajDict['trajDict'].item() #extract dictionary from .npz file
-dId = list(dDict.keys()) #get IDs (keys to dictionary)
-dSt = [dDict[x]['startLoc'] for x in dId] #get starting locations
-getDictLoc = dict(zip(dSt,dId))  #create dict for quick lookup of dict key given start location (for GDP drifters)
+trajStoreName = dDir+'trajStore_04_04_24/' #simplified GDP drifter trajectories (see saveTrajectories in loadData.py)
+shardDir = './drifterDistances_shards/' #one result file per pld, reused when its inputs haven't changed
+nWorkers = None #number of worker processes (None uses every core)
 
 #array of drifter durations (PLD is pelagic larval duration, since we're interested in larvae)
 pldArr = np.arange(1,61)
 
-#load numerical drifter starting locations
-tMask, tLon, tLat, st2id, id2st = loadGrid(return_starts=True)
-
-#initialize dicts in which to save data
-numerical = {}
-centroids = {}
-drifters = {}
-starts = {}
-#iterate over all drifter durations
-for pld in pldArr:
+#GDP drifter data and start location dicts, loaded once in each process (see loadInputs)
+inputs = {}
+
+#load GDP drifter data and numerical drifter starting locations into inputs
+def loadInputs():
+    traj = loadTrajectories(trajStoreName) #load simplified GDP drifter trajectories (memory mapped)
+    inputs['dLonAll'] = traj['lon'] #GDP positions
+    inputs['dLatAll'] = traj['lat']
+    inputs['ageIndex'] = buildAgeIndex(traj['age'],traj['offsets']) #row of GDP positions at each integer-day age
+    #row in ageIndex for a start location (for GDP drifters)
+    inputs['rowOfStart'] = dict(zip(zip(traj['startLon'].tolist(),traj['startLat'].tolist()),range(len(traj['startLon']))))
+    inputs['st2id'], inputs['id2st'] = loadStarts() #numerical drifter starting locations
+
+#hash of the contents of a list of files
+def hashFiles(fileList):
+    h = hashlib.sha1()
+    for fName in fileList:
+        with open(fName,'rb') as f:
+            for chunk in iter(lambda: f.read(2**24),b''):
+                h.update(chunk)
+    return(h.hexdigest())
+
+#hash of the inputs shared by every pld (start dicts and GDP trajectory store) - hashed once, in the main process
+def sharedHash():
+    return(hashFiles([startName]+[trajStoreName+var+'.npy' for var in trajStoreVars]))
+
+#hash of everything a pld's dispersal vectors depend on - its numerical trajectory endpoints and the shared inputs (sHash,
+#from sharedHash)
+def inputHash(pld, sHash):
+    return(hashlib.sha1((hashFiles([trajName(pld)])+sHash).encode()).hexdigest())
+
+def shardName(pld):
+    return(shardDir+'pld%02d.npz'%(pld))
+
+#dispersal vectors of numerical drifters, their centroids, and GDP drifters for all IDs at a single pld
+def pldVectors(pld):
     idArr, lonArr, latArr = loadData(pld) #load numerical trajectory endpoints
-
-    print('pld is: %s days '%(pld)) #print pld
-    #iterate over ids in idArr
-    for trID in tqdm(np.unique(idArr)):
-        idMask = idArr==trID #only look at matching IDs for num. drifters
-        iLon = lonArr[idMask] #all lons for corresponding ID (num. drifters)
-        iLat = latArr[idMask] #all lats for corresponding ID (num. drifters)
-
-        cLon,cLat = getCentroid(iLon,iLat) #get centroid of numerical data
-
-        stLon,stLat = id2st[trID] #get ID for GDP drifters using starting location
-
-        mLen,mAng = np.array(list(zip(*[swe.dist([stLat,iLat[x]],[stLon,iLon[x]]) for x in np.arange(len(iLon))]))) #get magnitude and angle of dispersal of numerical drifter (m is for 'modeled')
-        xMod = mLen*np.sin(np.radians(mAng)) #get x/real component of numerical dispersal vectors
-        yMod = mLen*np.cos(np.radians(mAng)) #get y/imag component of numerical dispersal vectors
-        
-        wDid = getDictLoc[(stLon,stLat)] #get GDP drifter key for dict
-
-        dAge = dDict[wDid]['age'] #get age of GDP drifters
-        if np.amax(dAge)<pld*24*3600: 
-            continue #ignore drifters that do not have data at the desired PLD (some GDP drifters didn't have all 60 days of data)
-        else:
-            dIx = np.ravel(np.argwhere(dAge==pld*24*3600)) #otherwise find data where the age matches (time is in sec, so convert PLD to seconds)
-
-        if len(dIx)==0: #if PLD not present (missing data)
-            continue
-
-        dLon = dDict[wDid]['lon'][dIx] #GDP drifter longitude
-        dLat = dDict[wDid]['lat'][dIx] #GDP drifter latitude
-        if type(dLon)==np.ndarray: #handle array/float issue
-            dLon = dLon.item()
-            dLat = dLat.item()
-
-        dLen,dAng = swe.dist([stLat,dLat],[stLon,dLon]) #get magnitude and angle of GDP drifter dispersal
-        xDri = dLen*np.sin(np.radians(dAng)) #get x/real component of GDP dispersal vector
-        yDri = dLen*np.cos(np.radians(dAng)) #get y/imag component of GDP dispersal vector
-        
-        cLen,cAng = swe.dist([stLat,cLat],[stLon,cLon]) #get magnitude and angle of numerical centroid
-        xCen = cLen*np.sin(np.radians(cAng)) #get x/real component of centroid dispersal vector
-        yCen = cLen*np.cos(np.radians(cAng)) #get y/imag component of centroid dispersal vector
-
-        if np.any(np.isnan([xDri,yDri,xCen,yCen])): #ignore nans (divide by 0)
-            continue
-
-        #get numerical dispersal vectors as array of complex numbers:
-        nArr = xMod+1j*yMod
-        nArr = nArr.flatten()
-        numerical[(pld,trID)] = nArr
-        centroids[(pld,trID)] = xCen+1j*yCen #centroid as complex number
-        drifters[(pld,trID)] = xDri+1j*yDri #GDP drifter as complex number
-
-#save distance dict as .npz file (may revise in future for a better storage scheme)
-if True:        
-    np.savez('drifterDistances_6_24_24.npz',numerical=numerical,centroids=centroids,drifters=drifters)
+    if np.any(idArr[1:]<idArr[:-1]): #(files from trajByDuration are already sorted by ID)
+        idArr, idSort = sortByID(idArr)
+        lonArr = lonArr[idSort]
+        latArr = latArr[idSort]
+
+    #group numerical drifters by ID once, then compute centroids and dispersal vectors for all IDs at once
+    unqIDs, offsets = segmentOffsets(idArr)
+    cLonArr,cLatArr = segmentCentroid(lonArr,latArr,offsets) #centroid of numerical data for each ID
+    stLonArr,stLatArr = np.array([inputs['id2st'][trID] for trID in unqIDs]).T #starting location of each ID
+    nAll = dispersalVectors(segmentRepeat(stLonArr,offsets),segmentRepeat(stLatArr,offsets),lonArr,latArr) #dispersal vectors of numerical drifters (from modeled endpoints)
+    cAll = dispersalVectors(stLonArr,stLatArr,cLonArr,cLatArr) #numerical centroid dispersal vectors
+
+    #GDP drifter positions at this PLD for all IDs in one gather (get GDP drifter for each ID using starting location)
+    dRows = np.array([inputs['rowOfStart'][(stLon,stLat)] for stLon,stLat in zip(stLonArr,stLatArr)])
+    dObs = inputs['ageIndex'][dRows,pld-1]
+    hasPld = dObs>=0 #ignore drifters that do not have data at the desired PLD (some GDP drifters didn't have all 60 days of data, or have gaps)
+    dAll = np.full(len(unqIDs),np.nan+0j)
+    dAll[hasPld] = dispersalVectors(stLonArr[hasPld],stLatArr[hasPld],inputs['dLonAll'][dObs[hasPld]],inputs['dLatAll'][dObs[hasPld]]) #GDP drifter dispersal vectors
+
+    #keep IDs with a GDP drifter at this pld, ignoring nans (divide by 0)
+    keep = hasPld&~np.isnan(dAll)&~np.isnan(cAll)
+    print('pld %s: %s of %s IDs kept'%(pld,np.sum(keep),len(unqIDs)))
+    return(dict(ID=unqIDs[keep],
+                centroids=cAll[keep], #centroids as complex numbers
+                drifters=dAll[keep], #GDP drifters as complex numbers
+                numerical=nAll[segmentRepeat(keep,offsets)], #numerical dispersal vectors as arrays of complex numbers
+                numCounts=np.diff(offsets)[keep]))
+
+#compute one pld and save it as a shard, unless a shard computed from the same inputs already exists
+def runPld(pld, sHash):
+    pHash = inputHash(pld,sHash)
+    if os.path.exists(shardName(pld)):
+        with np.load(shardName(pld)) as shard:
+            if str(shard['inputHash'])==pHash:
+                return(pld,False)
+    if len(inputs)==0:
+        loadInputs()
+    vectors = pldVectors(pld)
+    tmpName = shardName(pld)[:-4]+'_tmp.npz' #(written under a temporary name so an interrupted run doesn't leave a bad shard)
+    np.savez(tmpName,inputHash=pHash,**vectors)
+    os.replace(tmpName,shardName(pld))
+    return(pld,True)
+
+#combine the shards for all plds into the dispersal vector store (see saveDistances in loadData.py)
+def mergeShards(pldArr):
+    shards = [dict(np.load(shardName(pld))) for pld in pldArr]
+    saveDistances(np.concatenate([np.full(len(x['ID']),pld) for pld,x in zip(pldArr,shards)]),
+                  *[np.concatenate([x[var] for x in shards]) for var in ['ID','centroids','drifters','numerical','numCounts']])
+
+if __name__=='__main__':
+    os.makedirs(shardDir,exist_ok=True)
+    t1 = time.time()
+    #fan plds out across processes - each worker loads the GDP data once, and only when it has a pld to compute
+    sHash = sharedHash()
+    with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+        done = [job.result() for job in as_completed([pool.submit(runPld,pld,sHash) for pld in pldArr])]
+    computed = sorted([pld for pld,new in done if new])
+    print('computed %s plds (%s), reused %s unchanged in %0.1fs'%(len(computed),computed,len(pldArr)-len(computed),time.time()-t1))
+
+    #save dispersal vectors as a columnar store of .npy files (see loadDistances in loadData.py)
+    mergeShards(pldArr)
@@ -5,9 +5,9 @@ import pandas as pd
 import cartopy.crs as ccrs
 import cartopy.feature as ftr
 import xarray as xr
-from loadData import loadGrid
+from loadData import loadGrid, saveTrajectories
 from tqdm import tqdm
-from functools import reduce
+import gdpRagged as gdp
 
 #load start positions (from /home/break/willlush/workfiles/drifter_validation/drifter_starts_and_traj
 print('loading start positions and times (from drifter_starts_and_traj.py)')
@@ -20,97 +20,88 @@ stLat = stLoad['lats']
 stID = stLoad['index_in_drifter_array'] #use as proper ids in runs...
 stTime = stLoad['times']
 
-#time back to seconds because this is a dumb way to store things...
-unixDT = pd.Timestamp('1970-01-01')
-stTimes = np.array([(x - unixDT)//pd.Timedelta('1s') for x in stTime])
-
 dDir = '/data/break/willlush/drifter_validation/drifter_traj/'
 dName = 'gdp_jul22_ragged_6h.nc'
-trData = nc.Dataset(dDir+dName,'r')
+trData = gdp.openGDP(dDir+dName)
 idList_compact = trData['ID'][:].data
-keepIds = trData['ID'][:][trData['DrogueCenterDepth'][:]==15.].data #15m drogue depth
 rowSizeList = trData['rowsize'][:].data
-drStat = trData['drogue_status'][:].data.astype(bool)
-
-idList = np.repeat(idList_compact,rowSizeList)
-stTraj = idList[stID]
-started = np.unique(idList[stID])
-assert np.all(np.isin(started,keepIds)) #double-check that start depth is ok
+offsets = gdp.rowOffsets(rowSizeList) #drifter k is obs[offsets[k]:offsets[k+1]] (uses gdpRagged.py)
 
-drLon = trData['lon'][:].data
-drLat = trData['lat'][:].data
-drTime = trData['time'][:].data
-#readTime = pd.to_datetime(dr_time,unit='s')
+#drifter and index along that drifter of each start position
+stDr, stLocal = gdp.obsToDrifter(offsets,stID)
+stTraj = idList_compact[stDr]
+stOrder = np.lexsort((stLocal,stTraj)) #by drifter, then along trajectory
 
 maxAge = 60.*24.*60.*60. #60 days (in seconds)
-maxLen = int(maxAge/6/3600)+1 #maximum length of record, assuming 6 hr intervals
-
-lonArr = []
-latArr = []
-timeArr = []
-ageArr = []
-indIDArr = []
-print('start main loop')
-saveDict = {}
-counter = 0
-for ID in tqdm(started):
-    stMsk = stTraj==ID
-    lstLon = stLon[stMsk]
-    lstLat = stLat[stMsk]
-    lstTime = stTimes[stMsk]
-    
-    idMask = idList==ID
-    idLon = drLon[idMask]
-    idLat = drLat[idMask]
-    idTime = drTime[idMask]
-    idDr = drStat[idMask] #drifter attached?
+filters = [gdp.drogueDepth(15.),gdp.drogueOn()] #15m drogue depth, drogue attached
+blockObs = 2**22 #observations read at a time (whole drifters, see gdpRagged.py)
 
-    #get index of starting locations
-    chArg1 = np.ravel(np.argwhere(np.isin(idLon,lstLon)))
-    chArg2 = np.ravel(np.argwhere(np.isin(idLat,lstLat)))
-    chArg3 = np.ravel(np.argwhere(np.isin(idTime,lstTime)))
-    common = reduce(np.intersect1d, (chArg1, chArg2, chArg3))
+#end (exclusive) of the points within maxAge of each start row st0, searching only within the start's drifter (drIdx is the
+#drifter of every row) - times increase along each drifter, so drifter index*span+time is sorted over all rows
+def windowEnd(drTime, drIdx, st0, maxAge):
+    t0 = drTime.min()
+    span = np.float64(drTime.max()-t0+maxAge+1.)
+    key = drIdx*span+(drTime-t0)
+    return(np.searchsorted(key,drIdx[st0]*span+(drTime[st0]-t0)+maxAge,side='right'))
 
-    for ix in common: #make each trajectory
-        tLon = idLon[ix:] #lons
-        tLat = idLat[ix:] #lats
-        tTime = idTime[ix:] #time (s)
-        tDr = idDr[ix:] #drogue attached?
+#make the trajectories one block of drifters at a time, from the observations that pass the filters - each is the points
+#from its start position to maxAge (within its drifter, whatever the sampling)
+print('making trajectories')
+segs = {var:[] for var in ['start','len','lon','lat','time','age']}
+for block in tqdm(gdp.iterBlocks(trData,columns=('obs','drifter','lon','lat','time'),filters=filters,blockObs=blockObs)):
+    row = np.minimum(np.searchsorted(block['obs'],stID),len(block['obs'])-1)
+    inBlock = np.flatnonzero(block['obs'][row]==stID)
+    if len(inBlock)==0:
+        continue
+    inBlock = inBlock[np.argsort(row[inBlock])] #by drifter, then along trajectory
+    st0 = row[inBlock] #first point of each trajectory
+    winLen = windowEnd(block['time'],block['drifter'],st0,maxAge)-st0
+    seg = np.repeat(np.arange(len(st0)),winLen) #trajectory of each window point
+    win = np.arange(winLen.sum())-np.repeat(np.cumsum(winLen)-winLen,winLen)+st0[seg]
+    segs['start'].append(inBlock)
+    segs['len'].append(winLen)
+    for var in ['lon','lat','time']:
+        segs[var].append(block[var][win])
+    segs['age'].append(block['time'][win]-block['time'][st0][seg])
+segs = {var:np.concatenate(segs[var]) for var in segs}
+assert np.array_equal(np.sort(segs['start']),np.arange(len(stID))) #double-check every start is a 15m drifter with its drogue on
+assert np.array_equal(segs['lon'][np.cumsum(segs['len'])-segs['len']],stLon[segs['start']]) #double-check start positions
+assert np.array_equal(segs['lat'][np.cumsum(segs['len'])-segs['len']],stLat[segs['start']])
 
-        tAge = tTime-tTime[0]
-        ageMask = tAge<=maxAge
+#put trajectories in stOrder
+segPos = np.empty(len(stID),dtype=np.int64)
+segPos[segs['start']] = np.arange(len(stID))
+perm = segPos[stOrder]
+segLen = segs['len'][perm]
+segOff = (np.cumsum(segs['len'])-segs['len'])[perm]
+tInd = np.arange(segLen.sum())-np.repeat(np.cumsum(segLen)-segLen,segLen)+np.repeat(segOff,segLen)
 
-        cMsk = tDr & ageMask
-        tLon = tLon[cMsk]
-        tLat = tLat[cMsk]
-        tTime = tTime[cMsk]
-        tAge = tAge[cMsk]
-
-        saveDict[counter]={'startLoc':(tLon[0],tLat[0]),
-                           'lon':tLon,
-                           'lat':tLat,
-                           'time':tTime,
-                           'age':tAge,
-                           'traj':ID}
-        counter+=1
-        
-
-    # #look for time jumps...
-    # tDiff = np.diff(idTime)
-    
-    if False:
-        p.figure()
-        p.clf()
-        cMap = p.axes(projection=ccrs.PlateCarree())
-        cMap.add_feature(ftr.COASTLINE,linewidth=0.3,zorder=100)
-        cMap.set_global()
-        #cMap.plot(stLon,stLat,'r.')
-        cMap.plot(idLon[idDr],idLat[idDr])
-        cMap.plot(idLon[~idDr],idLat[~idDr])
-        cMap.plot(lstLon,lstLat,'r*')
-        cMap.plot(idLon[common],idLat[common],'bo')
-        #cMap.plot(stLon[ID],stLat[ID],'r*')
-        p.show(block=False)
+#plot a single drifter with its start positions
+if False:
+    whichDr = stDr[stOrder[0]]
+    drSl = gdp.drifterSlice(offsets,whichDr)
+    idLon = trData['lon'][drSl].data
+    idLat = trData['lat'][drSl].data
+    idDr = trData['drogue_status'][drSl].data.astype(bool)
+    common = stLocal[stDr==whichDr]
+    p.figure()
+    p.clf()
+    cMap = p.axes(projection=ccrs.PlateCarree())
+    cMap.add_feature(ftr.COASTLINE,linewidth=0.3,zorder=100)
+    cMap.set_global()
+    cMap.plot(idLon[idDr],idLat[idDr])
+    cMap.plot(idLon[~idDr],idLat[~idDr])
+    cMap.plot(idLon[common],idLat[common],'bo')
+    p.show(block=False)
 
+#save trajectories as a columnar store of .npy files (see saveTrajectories in loadData.py)
 if True:
-    np.savez('trajDict_04_04_24.npz',trajDict=saveDict)
+    saveTrajectories(*[segs[var][tInd] for var in ['lon','lat','time','age']],segLen,stTraj[stOrder],dName='trajStore_04_04_24/')
+
+#convert trajectories saved as a pickled dict of segments ({'startLoc','lon','lat','time','age','traj'} for each) to the store
+if False:
+    dDict = np.load('trajDict_04_04_24.npz',allow_pickle=True)['trajDict'].item()
+    segs = [dDict[x] for x in dDict]
+    saveTrajectories(*[np.concatenate([np.ravel(x[var]) for x in segs]) for var in ['lon','lat','time','age']],
+                     [len(np.ravel(x['lon'])) for x in segs],[x['traj'] for x in segs],*np.array([x['startLoc'] for x in segs]).T,
+                     dName='trajStore_04_04_24/')
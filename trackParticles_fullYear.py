@@ -1,31 +1,127 @@
-#Code to track all particles starting during a given year (uses particleTracking_core.py)
+#Code to track all particles starting during a range of years (uses particleTracking_core.py)
+#each year is tracked in its own worker process, so a full reanalysis (2007-2022) runs in parallel across the node
 
 #import necessary libraries
 import numpy as np
-import particleTrackingCore as ptc
+import os
+import json
+import time
+import resource
+import dask
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import particleTracking_core as ptc
 
-whichYear = 2022 #manually input year
+saveDir = '/home/willlush/particleTracking_temp/' #temporary directory for saving particle tracking results
+loadDir = '/data/break/willlush/drifter_validation/particle_start_positions/' #directory where startlists live
 
-saveDir = '/home/willlush/particleTracking_temp' #temporary directory for saving particle tracking results
-print('starting ', whichYear) #print year
-loadDir = '/data/break/willlush/drifter_validation/particle_start_positions/' #directory where startlist lives
-loadName = loadDir+'startLocsForRun_10daySep_newBathy%s.npz'%(whichYear) #startlist name
-loadLists = np.load(loadName,allow_pickle=True) #load startList
+#function to load the startlist for a given year, sorted by release time
+#ID is the start position ID of each release (None for startlists saved without IDs)
+def loadStartList(whichYear):
+    loadName = loadDir+'startLocsForRun_10daySep_newBathy%s.npz'%(whichYear) #startlist name
+    loadLists = np.load(loadName,allow_pickle=True) #load startList
 
-lon = loadLists['lon'] #start longitudes
-lat = loadLists['lat'] #start latitudes
-time = loadLists['time'] #start times
-#ID = loadLists['ID']
+    lon = loadLists['lon'] #start longitudes
+    lat = loadLists['lat'] #start latitudes
+    stTime = loadLists['time'] #start times
+    ID = loadLists['ID'] if 'ID' in loadLists.files else None #start position IDs
 
-tSort = np.argsort(time) #indices sorted by time 
+    tSort = np.argsort(stTime) #indices sorted by time
+    if ID is not None:
+        ID = ID[tSort]
+    return(lon[tSort],lat[tSort],stTime[tSort],ID)
 
-lon = lon[tSort] #sort longitudes by time
-lat = lat[tSort] #sort latitudes by time
-time = time[tSort] #sort time by time
-#ID = ID[tSort]
+#name of the output store for a given year (Parcels appends .zarr)
+def outName(whichYear):
+    return(saveDir+'drifterValidation_run_%s'%(whichYear))
 
-data = {'lon':lon, 'lat':lat, 'time':time,}#'ID':ID} #organize data into dict (possibly unnecessary)
+#marker written next to the output once tracking for a year has finished in output_mode
+#(an interrupted run leaves a partial .zarr store but no marker, and a year done in one mode isn't complete in the other)
+def doneName(whichYear, output_mode='trajectory'):
+    return(outName(whichYear)+'.%s.complete'%(output_mode))
 
-ptc.track_particles(data['lon'],data['lat'],data['time'],60,6.0,saveDir+'drifterValidation_run_%s'%(whichYear)) #run particle tracking using particle tracking core code
+def isComplete(whichYear, output_mode='trajectory'):
+    return(os.path.exists(doneName(whichYear,output_mode)))
 
-print('done with tracking for %s'%(whichYear)) #note that run is finished
+#physical memory of the node in GB
+def nodeMemory():
+    return(os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1024**3)
+
+#worker initializer - keeps each worker within memPerWorker (GB) by scaling the dask chunk size Parcels uses for loading
+#fields (chunksize='auto'), so a single worker doesn't take the whole node's memory
+#with hardLimit, the worker's data segment is also capped at memPerWorker (RLIMIT_DATA - unlike RLIMIT_AS this doesn't
+#count address space that is reserved but never used, e.g. by thread stacks and the JIT), so a runaway year fails with a
+#MemoryError instead of taking down the node
+def limitMemory(memPerWorker, hardLimit=False):
+    if memPerWorker is None:
+        return
+    nBytes = int(memPerWorker*1024**3)
+    chunkMB = max(nBytes//(8*1024**2),16) #leave room for several chunks in flight per field
+    dask.config.set({'array.chunk-size':'%dMiB'%(chunkMB)})
+    if hardLimit:
+        resource.setrlimit(resource.RLIMIT_DATA,(nBytes,nBytes))
+
+#track all particles starting in a single year, return wall time
+#output_mode is passed to track_particles ('trajectory' for zarr trajectories, 'endpoints' for daily-age positions only)
+def trackYear(whichYear, duration=60, output_frequency=6.0, output_mode='trajectory'):
+    t1 = time.time()
+    print('starting ', whichYear) #print year
+    lon, lat, stTime, ID = loadStartList(whichYear)
+    ptc.track_particles(lon,lat,stTime,duration,output_frequency,outName(whichYear),output_mode=output_mode,release_id=ID) #run particle tracking using particle tracking core code
+    wallTime = time.time()-t1
+
+    #mark year as complete
+    with open(doneName(whichYear,output_mode),'w') as f:
+        json.dump({'year':int(whichYear),'particles':len(lon),'output_mode':output_mode,'wall_time':wallTime},f)
+    print('done with tracking for %s in %0.1fs'%(whichYear,wallTime)) #note that run is finished
+    return(whichYear,wallTime)
+
+#track a range of years across a process pool, skipping years that are already complete
+#nWorkers defaults to the number of cores, memPerWorker (GB) is optional - with it, no more workers are started than fit in
+#the node's memory, and hardLimit also caps each worker's memory (see limitMemory)
+def trackYears(yrList, nWorkers=None, memPerWorker=None, duration=60, output_frequency=6.0, output_mode='trajectory', hardLimit=False):
+    todo = [yr for yr in yrList if not isComplete(yr,output_mode)]
+    for yr in yrList:
+        if yr not in todo:
+            print('skipping %s, %s output already complete'%(yr,output_mode))
+    if len(todo)==0:
+        return({})
+
+    if nWorkers is None:
+        nWorkers = os.cpu_count()
+    nWorkers = min(nWorkers,len(todo))
+    if memPerWorker is not None:
+        fit = max(int(nodeMemory()//memPerWorker),1)
+        if fit<nWorkers:
+            print('using %s workers (%0.1f GB each on a %0.1f GB node) instead of %s'%(fit,memPerWorker,nodeMemory(),nWorkers))
+            nWorkers = fit
+
+    wallTimes = {}
+    failed = []
+    t1 = time.time()
+    with ProcessPoolExecutor(max_workers=nWorkers,initializer=limitMemory,initargs=(memPerWorker,hardLimit)) as pool:
+        jobs = {pool.submit(trackYear,yr,duration,output_frequency,output_mode):yr for yr in todo}
+        for job in as_completed(jobs):
+            try:
+                yr, wallTime = job.result()
+                wallTimes[yr] = wallTime
+            except Exception as err: #keep other years running if one fails
+                print('tracking failed for %s: %s'%(jobs[job],err))
+                failed.append(jobs[job])
+
+    #report per-year wall time
+    print('year   wall time (s)')
+    for yr in sorted(wallTimes):
+        print('%s   %0.1f'%(yr,wallTimes[yr]))
+    print('total wall time %0.1fs on %s workers'%(time.time()-t1,nWorkers))
+    if len(failed)>0:
+        print('failed years: %s'%(sorted(failed)))
+    return(wallTimes)
+
+if __name__=='__main__':
+    yrList = np.arange(2007,2023) #years to track
+    nWorkers = None #number of worker processes (None uses every core)
+    memPerWorker = None #memory budget per worker in GB (None for no limit)
+    hardLimit = False #also cap each worker's data segment at memPerWorker (see limitMemory)
+    output_mode = 'trajectory' #'endpoints' writes only positions at integer-day ages (see trajByDuration.useEndpoints)
+
+    trackYears(yrList,nWorkers=nWorkers,memPerWorker=memPerWorker,output_mode=output_mode,hardLimit=hardLimit)
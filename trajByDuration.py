@@ -1,4 +1,5 @@
 #Code to add IDs and organize by drifter duration, saves output files in netcdf format
+#each year's tracking output is read once, and positions for every drifter duration are extracted from it in a single pass
 import numpy as np
 import pylab as p
 import netCDF4 as nc
@@ -6,8 +7,18 @@ import xarray as xr
 import zarr
 import cartopy.crs as ccrs
 import cartopy.feature as ftr
+from concurrent.futures import ThreadPoolExecutor
+import zarrColumns as zc
 
 yrList = np.arange(2007,2021) #list of years to iterate over
+pldArr = np.arange(1,61,1) #drifter durations (PLD is for pelagic larval duration, since I'm thinking about larvae)
+useEndpoints = False #read positions from endpoint files (track_particles with output_mode='endpoints') instead of zarr trajectories
+nWorkers = 4 #number of years read at the same time
+outputHours = 6. #hours between trajectory outputs (output_frequency in trackParticles_fullYear.py)
+selectiveReads = True #read only the zarr chunks holding observations at integer-day ages (see selectedHits)
+
+#path to zarr arrays
+dataDir = None
 
 #path to directory for saving output data
 saveDict = None
@@ -18,85 +29,199 @@ loadStarts = np.load(dName+'startPosition_idDicts.npz',allow_pickle=True)
 st2id = loadStarts['start2id'].item() #dict to go from start location to ID
 id2st = loadStarts['id2start'].item() #dict to go from ID to starting location
 
-#iterate over all drifter durations (PLD is for pelagic larval duration, since I'm thinking about larvae)
-for PLD in np.arange(1,61,1):
-    pldS = PLD*24.*3600. #get drifter duration in seconds
-
-    #initialize lists for saving data
-    idArr = []
-    lonArr = []
-    latArr = []
-    
-    #loop over years
-    for yr in yrList:
-        dataDir = None #path to zarr arrays
-        if (yr != 2007) and (yr != 2008): #if statement to deal with typo in file naming
-            dataName = dataDir+'drifterValidation_run_%s.zarr'%(yr)
-        else:
-            dataName = dataDir+'drifterValidation_run__%s.zarr'%(yr)
-        print(yr) #print year
-
-        #get trajectory endpoints from zarr output files
-        dat = zarr.convenience.open(dataName, 'r')
-        time = dat.time[:]
-        nanMask = ~np.all(np.isnan(time),axis=1)
-        time = time[nanMask]
-        lat = dat.lat[:][nanMask]
-        lon = dat.lon[:][nanMask]
-        age = dat.age[:][nanMask]
-        maxLen = pldS/(6.*3600.)
-        nzLength = np.count_nonzero(~np.isnan(age),axis=1)
-        nzMask = nzLength<maxLen
-
-        lat = lat[~nzMask]
-        lon = lon[~nzMask]
-        age = age[~nzMask]
-
-        ageMask = age==pldS
-        doubles = np.count_nonzero(ageMask,axis=1)==2
-        lat = lat[~doubles]
-        lon = lon[~doubles]
-        age = age[~doubles]
-        ageMask = ageMask[~doubles]
-
-        ageLon = lon[ageMask]
-        ageLat = lat[ageMask]
-        included = np.any(ageMask,axis=1)
-        #get IDs from each starting position
-        lon0 = lon[included][:,0]
-        lat0 = lat[included][:,0]
-        list2id = list(zip(lon0,lat0))
+#name of the zarr output for a given year
+def yearName(yr):
+    if (yr != 2007) and (yr != 2008): #if statement to deal with typo in file naming
+        return(dataDir+'drifterValidation_run_%s.zarr'%(yr))
+    else:
+        return(dataDir+'drifterValidation_run__%s.zarr'%(yr))
 
-        #add ids to whichID
+#IDs of the particles included at a given PLD - carried through tracking (trackID) or matched from starting positions
+def getIDs(trackID, lon0, lat0):
+    if trackID is not None and np.all(trackID>=0): #IDs were carried through tracking
+        whichID = list(trackID.astype(int))
+    else:
+        #older runs without IDs - match starting positions to IDs
+        list2id = list(zip(lon0,lat0))
         whichID = []
         for pos in list2id:
             if pos in st2id.keys():
                 whichID.append(st2id[pos])
             else:
                 whichID.append(np.nan)
-        #check to make sure lens match
-        assert len(ageLon)==len(whichID), 'ID and lon/lat arrs do not correspond'
-
-        #add lats, lons, ids to lists
-        idArr.extend(whichID)
-        lonArr.extend(ageLon)
-        latArr.extend(ageLat)
-        
-    #convert to arrays, sort by ID,  and save as netcdf
-    idArr = np.array(idArr)
-    lonArr = np.array(lonArr)
-    latArr = np.array(latArr)
-    idSort = np.argsort(idArr)
-
-    idArr = idArr[idSort]
-    lonArr = lonArr[idSort]
-    latArr = latArr[idSort]
-
-    ds = xr.Dataset(data_vars=dict(idArr=(["obs"],idArr),
-                                   lonArr=(["obs"], lonArr),
-                                   latArr=(["obs"], latArr),),
-                    attrs=dict(description="simulated particle positions after %s days"%(PLD)),)
-    ds.to_netcdf(saveDict+'particlePositions_pld%02d.nc'%(PLD))
-
-
-        
+    return(whichID)
+
+#positions at an age of pld days for every pld in pldArr, from the endpoint file for a single year
+def endpointPositions(yr, pldArr):
+    ends = xr.open_dataset(dataDir+'drifterValidation_run_%s_endpoints.nc'%(yr))
+    pldEnd = ends['pld'].values
+    particle = ends['particle'].values #index of each particle in the startlist
+    endLon = ends['lon'].values
+    endLat = ends['lat'].values
+    lon0All = ends['lon0'].values
+    lat0All = ends['lat0'].values
+    idAll = ends['ID'].values if 'ID' in ends else None
+    ends.close()
+
+    positions = {}
+    for PLD in pldArr:
+        pMask = pldEnd==PLD
+        pIdx = particle[pMask]
+        trackID = idAll[pIdx] if idAll is not None else None
+        positions[PLD] = (getIDs(trackID,lon0All[pIdx],lat0All[pIdx]),endLon[pMask],endLat[pMask])
+    return(positions)
+
+#observations at an age of pld days for every pld in pldArr, in full rows of trajectory output (time and age)
+#every observation at an integer-day age is found in one pass, then split by pld (keeping only trajectories that are long
+#enough, and dropping trajectories with the age twice) - returns (row, col) of the observations for each pld
+def fullRowHits(time, age, pldArr):
+    nanMask = ~np.all(np.isnan(time),axis=1)
+    nzLength = np.count_nonzero(~np.isnan(age),axis=1)
+
+    #observations at integer-day ages (row-major, as for a boolean mask of the full array)
+    day = age.astype(np.float64)/(24.*3600.)
+    row, col = np.nonzero(day==np.round(day))
+    day = day[row,col].astype(int)
+
+    hits = {}
+    for PLD in pldArr:
+        pldS = PLD*24.*3600. #get drifter duration in seconds
+        maxLen = pldS/(outputHours*3600.)
+        atAge = np.flatnonzero(day==PLD)
+        pRow = row[atAge]
+        pCol = col[atAge]
+        #number of observations at this age for the row of each observation
+        unqRow, rowInv, rowCount = np.unique(pRow,return_inverse=True,return_counts=True)
+        keep = nanMask[pRow]&(nzLength[pRow]>=maxLen)&(rowCount[rowInv]!=2)
+        hits[PLD] = (pRow[keep],pCol[keep])
+    return(hits)
+
+#observations at an age of pld days for every pld in pldArr, reading only the columns of the zarr output they can be in
+#with outputs every outputHours from an age of 0, the age of pld days is in column pld*24/outputHours - that column, the next
+#one (to find trajectories with the age twice), column 0 (starting positions) and the last column are read, using zarrColumns.py
+#rows that are off the regular output grid on the columns read (or not nan-padded at the end) are read in full and handled
+#by fullRowHits - assumes ages increase by outputHours along each row apart from a final write on deletion, as in Parcels output
+#returns (row, lon, lat) of the observations for each pld and the starting lon and lat of every row
+def selectedHits(dat, pldArr, stats):
+    nObs = dat['age'].shape[1]
+    outS = outputHours*3600.
+    pldCol = {PLD:int(round(PLD*24./outputHours)) for PLD in pldArr}
+    posCols = np.unique([0]+[pldCol[PLD] for PLD in pldArr if pldCol[PLD]<nObs])
+    ageCols = np.unique(np.r_[posCols,[pldCol[PLD]+1 for PLD in pldArr if pldCol[PLD]+1<nObs],nObs-1]).astype(int)
+    age = zc.readSelection(dat['age'],cols=ageCols,stats=stats)
+    lon = zc.readSelection(dat['lon'],cols=posCols,stats=stats)
+    lat = zc.readSelection(dat['lat'],cols=posCols,stats=stats)
+
+    #rows with an age of 0 in column 0, ages on the output grid, and nans only at the end (on the columns read) - the last age
+    #in a row can also be from the write on deletion (between the previous output and this one, or a second write at its age)
+    #rows without any ages read are empty (no observations at any age)
+    grid = ageCols*outS
+    ageNan = np.isnan(age)
+    nextNan = np.c_[ageNan[:,1:],np.ones(len(age),dtype=bool)] #next column read is nan (or there are no more)
+    final = nextNan&(age>=grid-outS)&(age<grid)
+    regular = (age[:,0]==0.)&np.all((age==grid)|ageNan|final,axis=1)&np.all(ageNan[:,1:]>=ageNan[:,:-1],axis=1)
+    regular |= np.all(ageNan,axis=1)
+    irr = np.flatnonzero(~regular)
+    stats['irregular'] = len(irr)
+    if len(irr)>0: #read time and age of irregular rows in full, and positions only where they're at an age of pld days
+        irrHits = fullRowHits(zc.readSelection(dat['time'],rows=irr,stats=stats),zc.readSelection(dat['age'],rows=irr,stats=stats),pldArr)
+        irrCols = np.unique(np.concatenate([irrHits[PLD][1] for PLD in pldArr])).astype(int)
+        irrLon = zc.readSelection(dat['lon'],rows=irr,cols=irrCols,stats=stats)
+        irrLat = zc.readSelection(dat['lat'],rows=irr,cols=irrCols,stats=stats)
+
+    hits = {}
+    for PLD in pldArr:
+        pldS = PLD*24.*3600. #get drifter duration in seconds
+        col = pldCol[PLD]
+        if col<nObs and col*outS==pldS:
+            atAge = regular&(age[:,np.searchsorted(ageCols,col)]==pldS)
+            if col+1<nObs: #drop trajectories with the age twice
+                atAge &= age[:,np.searchsorted(ageCols,col+1)]!=pldS
+            pRow = np.flatnonzero(atAge)
+            pLon = lon[pRow,np.searchsorted(posCols,col)]
+            pLat = lat[pRow,np.searchsorted(posCols,col)]
+            pCol = np.full(len(pRow),col)
+        else:
+            pRow, pCol, pLon, pLat = [np.zeros(0,dtype=x) for x in [int,int,lon.dtype,lat.dtype]]
+        if len(irr)>0: #add irregular rows, in row-major order
+            iRow, iCol = irrHits[PLD]
+            pRow = np.r_[pRow,irr[iRow]]
+            pCol = np.r_[pCol,iCol]
+            pLon = np.r_[pLon,irrLon[iRow,np.searchsorted(irrCols,iCol)]]
+            pLat = np.r_[pLat,irrLat[iRow,np.searchsorted(irrCols,iCol)]]
+            order = np.lexsort((pCol,pRow))
+            pRow, pLon, pLat = pRow[order], pLon[order], pLat[order]
+        hits[PLD] = (pRow,pLon,pLat)
+    return(hits,lon[:,0],lat[:,0])
+
+#positions at an age of pld days for every pld in pldArr, from the zarr trajectories for a single year (read once)
+def trajectoryPositions(yr, pldArr):
+    dat = zarr.open(yearName(yr),mode='r')
+    trackID = dat['ID'][:] if 'ID' in dat else None #start ID stored during tracking (once per trajectory)
+    if selectiveReads:
+        stats = {'read':0}
+        hits, lon0, lat0 = selectedHits(dat,pldArr,stats)
+        stored = np.sum([zc.storedBytes(dat[var]) for var in ['time','lat','lon','age']])
+        print('%s: read %0.1f of %0.1f MB stored (%s irregular rows read in full)'%(yr,stats['read']/1e6,stored/1e6,stats['irregular']))
+    else:
+        lat = dat['lat'][:]
+        lon = dat['lon'][:]
+        rowCol = fullRowHits(dat['time'][:],dat['age'][:],pldArr)
+        hits = {PLD:(row,lon[row,col],lat[row,col]) for PLD,(row,col) in rowCol.items()}
+        lon0 = lon[:,0]
+        lat0 = lat[:,0]
+
+    positions = {}
+    for PLD in pldArr:
+        pRow, ageLon, ageLat = hits[PLD]
+        included = np.unique(pRow)
+        #get IDs from each starting position
+        pID = trackID[included] if trackID is not None else None
+        positions[PLD] = (getIDs(pID,lon0[included],lat0[included]),ageLon,ageLat)
+    return(positions)
+
+#positions at every pld for a single year
+def yearPositions(yr):
+    print(yr) #print year
+    if useEndpoints: #positions at integer-day ages were written directly during tracking
+        return(endpointPositions(yr,pldArr))
+    else: #get trajectory endpoints from zarr output files
+        return(trajectoryPositions(yr,pldArr))
+
+if __name__=='__main__':
+    #read years concurrently (results are combined in year order below)
+    with ThreadPoolExecutor(max_workers=nWorkers) as pool:
+        yearData = list(pool.map(yearPositions,yrList))
+
+    #combine years for each drifter duration
+    for PLD in pldArr:
+        #initialize lists for saving data
+        idArr = []
+        lonArr = []
+        latArr = []
+
+        for positions in yearData:
+            whichID, ageLon, ageLat = positions[PLD]
+            #check to make sure lens match
+            assert len(ageLon)==len(whichID), 'ID and lon/lat arrs do not correspond'
+
+            #add lats, lons, ids to lists
+            idArr.extend(whichID)
+            lonArr.extend(ageLon)
+            latArr.extend(ageLat)
+
+        #convert to arrays, sort by ID,  and save as netcdf
+        idArr = np.array(idArr)
+        lonArr = np.array(lonArr)
+        latArr = np.array(latArr)
+        idSort = np.argsort(idArr)
+
+        idArr = idArr[idSort]
+        lonArr = lonArr[idSort]
+        latArr = latArr[idSort]
+
+        ds = xr.Dataset(data_vars=dict(idArr=(["obs"],idArr),
+                                       lonArr=(["obs"], lonArr),
+                                       latArr=(["obs"], latArr),),
+                        attrs=dict(description="simulated particle positions after %s days"%(PLD)),)
+        ds.to_netcdf(saveDict+'particlePositions_pld%02d.nc'%(PLD))
@@ -0,0 +1,85 @@
+#Module for reading selected rows/columns of 2d zarr arrays (e.g. Parcels trajectory output, trajectory x obs) - only the
+#chunks containing the selection are read, chunks are decompressed in parallel, and the bytes read are counted so they can be
+#compared with the bytes stored
+#chunks are read straight from the store with zarr v2's layout (chunk keys, compressor and filters on the array) - with other
+#zarr versions, selections are read with zarr's own get_orthogonal_selection instead, and the bytes read are estimated
+import numpy as np
+import zarr
+from concurrent.futures import ThreadPoolExecutor
+
+nWorkers = 8 #number of threads reading/decompressing chunks
+zarrV2 = zarr.__version__.split('.')[0]=='2' #chunks can be read directly (chunkKey and readChunk rely on zarr v2 internals)
+
+#store key of chunk idx (tuple of chunk indices) of arr (zarr v2 only)
+def chunkKey(arr, idx):
+    sep = getattr(arr,'_dimension_separator',None) or '.'
+    key = sep.join([str(i) for i in idx])
+    return(arr.path+'/'+key if arr.path else key)
+
+#read and decompress a single chunk - returns the chunk (full chunk shape, also at the array edges) and the bytes read
+#(zarr v2 only)
+def readChunk(arr, idx):
+    try:
+        raw = arr.store[chunkKey(arr,idx)]
+    except KeyError: #chunk was never written
+        fill = arr.fill_value if arr.fill_value is not None else 0
+        return(np.full(arr.chunks,fill,dtype=arr.dtype),0)
+    decoded = raw
+    if arr.compressor is not None:
+        decoded = arr.compressor.decode(decoded)
+    if arr.filters:
+        for fltr in reversed(arr.filters):
+            decoded = fltr.decode(decoded)
+    chunk = np.frombuffer(decoded,dtype=arr.dtype).reshape(arr.chunks,order=arr.order)
+    return(chunk,len(raw))
+
+#bytes stored for arr (a property in zarr v2, a method in later versions)
+def storedBytes(arr):
+    return(arr.nbytes_stored() if callable(arr.nbytes_stored) else arr.nbytes_stored)
+
+#bytes stored for arr, averaged over its chunks (for estimating bytes read without zarr v2)
+def storedPerChunk(arr):
+    return(storedBytes(arr)/np.prod([-(-n//c) for n,c in zip(arr.shape,arr.chunks)]))
+
+#read arr[rows][:,cols] (rows and cols are sorted indices, None for all) chunk by chunk, reading only chunks that hold part
+#of the selection - if stats (dict) is given, the bytes read are added to stats['read']
+def readSelection(arr, rows=None, cols=None, stats=None, workers=None):
+    nRow, nCol = arr.shape
+    rc, cc = arr.chunks
+    rows = np.arange(nRow) if rows is None else np.asarray(rows)
+    cols = np.arange(nCol) if cols is None else np.asarray(cols)
+    if not zarrV2: #let zarr read the chunks, and estimate the bytes read from the number of chunks in the selection
+        if stats is not None:
+            nChunks = len(np.unique(rows//rc))*len(np.unique(cols//cc))
+            stats['read'] = stats.get('read',0)+int(nChunks*storedPerChunk(arr))
+        return(arr.get_orthogonal_selection((rows,cols)))
+    out = np.empty((len(rows),len(cols)),dtype=arr.dtype)
+
+    #fill the part of out in chunk (ri, ci)
+    def fill(idx):
+        ri, ci = idx
+        r0, r1 = np.searchsorted(rows,[ri*rc,(ri+1)*rc])
+        c0, c1 = np.searchsorted(cols,[ci*cc,(ci+1)*cc])
+        chunk, nBytes = readChunk(arr,idx)
+        out[r0:r1,c0:c1] = chunk[np.ix_(rows[r0:r1]-ri*rc,cols[c0:c1]-ci*cc)]
+        return(nBytes)
+
+    jobs = [(ri,ci) for ri in np.unique(rows//rc) for ci in np.unique(cols//cc)]
+    with ThreadPoolExecutor(max_workers=workers if workers is not None else nWorkers) as pool:
+        nBytes = sum(pool.map(fill,jobs))
+    if stats is not None:
+        stats['read'] = stats.get('read',0)+nBytes
+    return(out)
+
+if __name__=='__main__':
+    #check selections against zarr's own indexing
+    if False:
+        arr = zarr.open('test_columns.zarr',mode='w',shape=(1003,245),chunks=(100,7),dtype='f4')
+        arr[:] = np.random.random(arr.shape)
+        arr[:,200:] = np.nan
+        stats = {}
+        cols = np.array([0,4,5,120,121,240,244])
+        rows = np.array([3,99,100,512,1002])
+        assert np.array_equal(readSelection(arr,cols=cols,stats=stats),arr.get_orthogonal_selection((slice(None),cols)),equal_nan=True)
+        assert np.array_equal(readSelection(arr,rows=rows),arr.get_orthogonal_selection((rows,slice(None))),equal_nan=True)
+        print('read %s of %s bytes stored'%(stats['read'],storedBytes(arr)))